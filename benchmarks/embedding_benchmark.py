@@ -0,0 +1,137 @@
+'''
+Embedding benchmark: throughput and accuracy of the HuggingFace embedding backends.
+
+Embeds the same synthetic corpus with the reference backend (PyTorch, fp32) and each
+candidate backend of `load_hf_embed_func`, and reports documents per second, the
+speedup over the reference and how far the vectors drift from it (minimum cosine
+similarity and top-k overlap of a nearest-neighbour search). A backend passes when
+its minimum cosine similarity is at least --tolerance.
+
+Downloads the model on first use; ONNX needs `pip install sentence-transformers[onnx]`.
+
+Usage:
+    python benchmarks/embedding_benchmark.py --model BAAI/bge-small-en-v1.5 --backends int8 onnx
+    python benchmarks/embedding_benchmark.py --model BAAI/bge-m3 --num-threads 8 --max-seq-length 512 --output embedding.json
+'''
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from stubs import make_corpus
+
+from ai_models.embedding import load_hf_embed_func, resolve_device
+
+
+def embed_corpus(embed_model, texts, batch_size, repeats):
+    '''
+    Embeds `texts` in batches `repeats` times after one warm-up batch.
+
+    Returns:
+        The vectors of the last run, and the best documents per second.
+    '''
+    embed_model.embed_documents(texts[:batch_size])
+
+    best = 0.0
+    for _ in range(repeats):
+        vectors = []
+        start = time.perf_counter()
+        for i in range(0, len(texts), batch_size):
+            vectors.extend(embed_model.embed_documents(texts[i:i + batch_size]))
+        best = max(best, len(texts) / (time.perf_counter() - start))
+
+    return np.asarray(vectors, dtype=np.float32), best
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def compare(reference, candidate, k):
+    '''
+    Cosine similarity between matching vectors, and the overlap of the top-k
+    neighbours of the first vectors (used as queries) in both spaces.
+    '''
+    reference, candidate = normalize(reference), normalize(candidate)
+    cosine = np.sum(reference * candidate, axis=1)
+
+    queries = min(100, len(reference))
+    reference_top = np.argsort(-(reference[:queries] @ reference.T), axis=1)[:, :k]
+    candidate_top = np.argsort(-(candidate[:queries] @ candidate.T), axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(reference_top, candidate_top)])
+
+    return {"min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean()), f"top{k}_overlap": float(overlap)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=str, default="BAAI/bge-small-en-v1.5")
+    parser.add_argument("--device", type=str, default="auto")
+    parser.add_argument("--backends", type=str, nargs="+", default=["int8", "onnx"])
+    parser.add_argument("--onnx-file", type=str, default=None, help="ONNX file of the model repository, e.g. a quantized one")
+    parser.add_argument("--num-docs", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--max-seq-length", type=int, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.99, help="Minimum cosine similarity to the reference")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    device = resolve_device(args.device)
+    texts = [doc.page_content for doc in make_corpus(args.num_docs)]
+    print(f"{args.model} on {device}, {len(texts)} documents, batch size {args.batch_size}")
+
+    def load(backend):
+        embed_model, _ = load_hf_embed_func(model_name=args.model,
+                                            device="cpu" if backend == "int8" else device,
+                                            backend=backend,
+                                            num_threads=args.num_threads,
+                                            max_seq_length=args.max_seq_length,
+                                            onnx_file_name=args.onnx_file if backend == "onnx" else None
+                                            )
+        return embed_model
+
+    reference, reference_dps = embed_corpus(load("torch"), texts, args.batch_size, args.repeats)
+    results = [{"backend": "torch", "docs_per_second": reference_dps, "speedup": 1.0}]
+
+    for backend in args.backends:
+        try:
+            vectors, dps = embed_corpus(load(backend), texts, args.batch_size, args.repeats)
+        except Exception as e:
+            # e.g. onnxruntime not installed, or int8 requested on a GPU-only build
+            results.append({"backend": backend, "error": str(e)})
+            continue
+
+        result = {"backend": backend, "docs_per_second": dps, "speedup": dps / reference_dps} | compare(reference, vectors, args.k)
+        result["within_tolerance"] = result["min_cosine"] >= args.tolerance
+        results.append(result)
+
+    print(f"\n{'backend':<8} {'docs/s':>9} {'speedup':>8} {'min cos':>8} {f'top{args.k}':>7}  ok")
+    for result in results:
+        if "error" in result:
+            print(f"{result['backend']:<8}  skipped: {result['error'][:80]}")
+            continue
+        print(f"{result['backend']:<8} {result['docs_per_second']:>9.1f} {result['speedup']:>7.2f}x "
+              f"{result.get('min_cosine', 1.0):>8.4f} {result.get(f'top{args.k}_overlap', 1.0):>7.3f}  "
+              f"{'yes' if result.get('within_tolerance', True) else 'NO'}")
+
+    if args.output:
+        report = {"timestamp": datetime.now().isoformat(timespec="seconds"),
+                  "model": args.model,
+                  "device": device,
+                  "settings": vars(args),
+                  "results": results
+                  }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
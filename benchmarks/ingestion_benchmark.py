@@ -0,0 +1,230 @@
+'''
+Ingestion benchmark: time and peak RSS per stage of the /upload flow.
+
+Generates PDFs of 10, 100 and 1,000 pages (configurable) and runs them through the
+same steps as /upload: SpooledUpload -> lazy_langchain_pdf_loader -> BM25
+statistics update -> add_documents_to_collection, into a local Milvus Lite file.
+Stages run one after another so each can be measured on its own. The per-stage
+breakdown is written as JSON so runs can be compared over time.
+
+Usage:
+    python benchmarks/ingestion_benchmark.py --pages 10 100 1000 --output ingestion.json
+    python benchmarks/ingestion_benchmark.py --stub-sparse     # no NLTK download needed
+'''
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+from stubs import HashingEmbeddings, HashingSparseEmbedding, make_vocabulary
+
+from utils.util import SpooledUpload
+from extraction.pdf import lazy_langchain_pdf_loader
+from databases.milvus import create_milvus, create_or_load_collection, add_documents_to_collection
+
+
+class RssSampler:
+    '''
+    Context manager sampling the resident set size of this process in a background
+    thread, to get the peak RSS of a single stage.
+    '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start_rss = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # Not Linux: fall back to the process-wide peak
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self.current_rss())
+        return False
+
+
+def write_pdf(file_path, num_pages, lines_per_page=45, words_per_line=12, seed=0):
+    '''
+    Writes a text-only PDF with `num_pages` pages of random words, without any PDF library.
+    '''
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(5_000, seed=seed)
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for _ in range(num_pages):
+        lines = [" ".join(rng.choices(vocabulary, k=words_per_line)) for _ in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 14 TL 50 780 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), num_pages)
+
+    with open(file_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+
+
+class BenchUpload:
+    '''
+    Minimal stand-in for FastAPI's UploadFile.
+    '''
+
+    def __init__(self, file_path):
+        self.filename = os.path.basename(file_path)
+        with open(file_path, "rb") as f:
+            self.file = io.BytesIO(f.read())
+
+
+def run_stage(stages, name, func):
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+
+    stages[name] = {"seconds": seconds,
+                    "peak_rss_mb": sampler.peak_rss / 2 ** 20,
+                    "rss_delta_mb": (sampler.peak_rss - sampler.start_rss) / 2 ** 20
+                    }
+    print(f"  {name:<14} {seconds:>9.3f} s   peak RSS {stages[name]['peak_rss_mb']:>8.1f} MB")
+    return result
+
+
+def benchmark_file(num_pages, work_dir, db_uri, client, embed_model, embed_dim, sparse_embed_model, args):
+    pdf_path = os.path.join(work_dir, f"bench_{num_pages}_pages.pdf")
+    write_pdf(pdf_path, num_pages)
+    collection_name = f"ingest_bench_{num_pages}"
+    print(f"\n{num_pages} pages ({os.path.getsize(pdf_path) / 2 ** 20:.1f} MB)")
+
+    create_or_load_collection(collection_name=collection_name, client=client, embed_dim=embed_dim)
+
+    stages = {}
+    upload = BenchUpload(pdf_path)
+    spooled = run_stage(stages, "save", lambda: SpooledUpload.from_upload(file=upload))
+
+    def extract():
+        with spooled.open() as stream:
+            return list(lazy_langchain_pdf_loader(file_path=stream,
+                                                  chunk_size=args.chunk_size,
+                                                  overlap=args.overlap,
+                                                  source=upload.filename
+                                                  ))
+
+    documents = run_stage(stages, "extract", extract)
+    if hasattr(sparse_embed_model, "add_documents"):
+        run_stage(stages, "sparse_fit", lambda: sparse_embed_model.add_documents([doc.page_content for doc in documents]))
+
+    status = run_stage(stages, "embed_insert", lambda: add_documents_to_collection(collection_name=collection_name,
+                                                                                   client=client,
+                                                                                   documents=documents,
+                                                                                   embed_model=embed_model,
+                                                                                   sparse_embed_model=sparse_embed_model,
+                                                                                   batch_size=args.insert_batch_size,
+                                                                                   insert_batch_bytes=int(args.insert_batch_mb * 2**20),
+                                                                                   columnar=args.columnar,
+                                                                                   db_uri=db_uri,
+                                                                                   dense_batch_size=args.dense_batch_size,
+                                                                                   sparse_batch_size=args.sparse_batch_size
+                                                                                   ))
+    run_stage(stages, "cleanup", spooled.close)
+
+    return {"pages": num_pages,
+            "chunks": len(documents),
+            "total_seconds": sum(stage["seconds"] for stage in stages.values()),
+            "stages": stages,
+            "insert_calls": status["insert_calls"],
+            "embed_insert_breakdown": status["time_taken"]
+            }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--overlap", type=int, default=200)
+    parser.add_argument("--dense-batch-size", type=int, default=32)
+    parser.add_argument("--sparse-batch-size", type=int, default=256)
+    parser.add_argument("--insert-batch-size", type=int, default=None, help="Row cap per insert (default: size by bytes)")
+    parser.add_argument("--insert-batch-mb", type=float, default=8)
+    parser.add_argument("--columnar", action="store_true", help="Insert column arrays instead of row dicts")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--hf-model", type=str, default=None, help="Use this HuggingFace embedding model instead of the stub")
+    parser.add_argument("--stub-sparse", action="store_true", help="Use a hashing sparse embedder instead of BM25")
+    parser.add_argument("--output", type=str, default="ingestion_benchmark.json")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="ingestion_bench_")
+    db_uri = os.path.join(work_dir, "bench.db")
+    client = create_milvus(db_uri=db_uri, make_new_db=True)
+
+    if args.hf_model:
+        from ai_models.embedding import load_hf_embed_func
+        embed_model, embed_dim = load_hf_embed_func(model_name=args.hf_model)
+    else:
+        embed_model, embed_dim = HashingEmbeddings(dim=args.dim), args.dim
+
+    runs = []
+    for num_pages in args.pages:
+        if args.stub_sparse:
+            sparse_embed_model = HashingSparseEmbedding()
+        else:
+            from ai_models.sparse_registry import IncrementalBM25SparseEmbedding
+            sparse_embed_model = IncrementalBM25SparseEmbedding()
+        runs.append(benchmark_file(num_pages, work_dir, db_uri, client, embed_model, embed_dim, sparse_embed_model, args))
+
+    report = {"timestamp": datetime.now().isoformat(timespec="seconds"),
+              "git_revision": git_revision(),
+              "settings": vars(args),
+              "runs": runs
+              }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+'''
+Retrieval benchmark: recall and latency of the hybrid retriever per dense index config and k.
+
+Generates a synthetic corpus, loads it with `add_documents_to_collection` into a local
+Milvus Lite file, runs a query set through `convert_collection_to_retriever` and reports
+p50/p95/p99 latency, QPS and recall@k against the exact FLAT collection. Uses stub
+embedders and a stub LLM, so it runs offline on CPU.
+
+Usage:
+    python benchmarks/retrieval_benchmark.py --num-docs 5000 --num-queries 200 --k 3 10
+    python benchmarks/retrieval_benchmark.py --configs '[{"index_type": "IVF_FLAT", "search_params": {"nprobe": 8}}]'
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from stubs import HashingEmbeddings, HashingSparseEmbedding, load_stub_llm, make_corpus, make_queries
+
+from databases.milvus import (create_milvus, create_or_load_collection, add_documents_to_collection,
+                              convert_collection_to_retriever, resolve_dense_index_config)
+from chains.retrieval_qa_chain import create_retreival_qa_chain
+
+
+DEFAULT_CONFIGS = [
+    {"index_type": "IVF_FLAT", "index_params": {"nlist": 128}, "search_params": {"nprobe": 8}},
+    {"index_type": "IVF_FLAT", "index_params": {"nlist": 128}, "search_params": {"nprobe": 32}},
+    {"index_type": "HNSW", "index_params": {"M": 16, "efConstruction": 200}, "search_params": {"ef": 64}},
+]
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000)
+
+
+def run_queries(retriever, queries):
+    '''
+    Runs every query through the retriever.
+
+    Returns:
+        latencies in seconds, and the retrieved texts per query.
+    '''
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        docs = retriever.invoke(query)
+        latencies.append(time.perf_counter() - start)
+        results.append([doc.page_content for doc in docs])
+    return latencies, results
+
+
+def recall_at_k(results, ground_truth):
+    recalls = []
+    for retrieved, expected in zip(results, ground_truth):
+        if expected:
+            recalls.append(len(set(retrieved) & set(expected)) / len(expected))
+    return float(np.mean(recalls)) if recalls else 0.0
+
+
+def load_collection(collection_name, client, documents, embed_model, sparse_embed_model, index_config, env_vars):
+    create_or_load_collection(collection_name=collection_name,
+                              client=client,
+                              embed_dim=embed_model.dim,
+                              index_config=index_config,
+                              meta_dir=env_vars['COLLECTION_META_DIR']
+                              )
+    status = add_documents_to_collection(collection_name=collection_name,
+                                         client=client,
+                                         documents=documents,
+                                         embed_model=embed_model,
+                                         sparse_embed_model=sparse_embed_model,
+                                         batch_size=1000
+                                         )
+    return status["time_taken"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-docs", type=int, default=2000)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, nargs="+", default=[3, 10])
+    parser.add_argument("--configs", type=str, default=None, help="JSON list of dense index configs to compare with FLAT")
+    parser.add_argument("--with-llm", action="store_true", help="Also time the full chain with the stub LLM")
+    parser.add_argument("--db-dir", type=str, default=None,
+                        help="Parent directory of the fresh run directory holding the Milvus Lite file (default: the system temp dir)")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    configs = json.loads(args.configs) if args.configs else DEFAULT_CONFIGS
+    # `create_milvus(make_new_db=True)` deletes the database directory, never hand it an existing one
+    db_dir = tempfile.mkdtemp(prefix="retrieval_bench_", dir=args.db_dir)
+    env_vars = {"MILVUS_LOCAL_URI": os.path.join(db_dir, "bench.db"),
+                "COLLECTION_META_DIR": os.path.join(db_dir, "collection_meta")
+                }
+
+    client = create_milvus(db_uri=env_vars['MILVUS_LOCAL_URI'], make_new_db=True)
+    embed_model = HashingEmbeddings(dim=args.dim)
+    sparse_embed_model = HashingSparseEmbedding()
+
+    documents = make_corpus(args.num_docs)
+    queries = make_queries(documents, args.num_queries)
+    print(f"Corpus: {len(documents)} documents, {len(queries)} queries, Milvus Lite at {env_vars['MILVUS_LOCAL_URI']}")
+
+    flat_config = resolve_dense_index_config("FLAT")
+    ingest_times = {"bench_flat": load_collection("bench_flat", client, documents, embed_model,
+                                                  sparse_embed_model, flat_config, env_vars)}
+
+    rows = []
+    for k in args.k:
+        flat_retriever = convert_collection_to_retriever(collection_name="bench_flat",
+                                                         env_vars=env_vars,
+                                                         embed_model=embed_model,
+                                                         sparse_embed_model=sparse_embed_model,
+                                                         k=k
+                                                         )
+        latencies, ground_truth = run_queries(flat_retriever, queries)
+        rows.append({"config": flat_config, "k": k, "ingest": ingest_times["bench_flat"], "latencies": latencies, "recall": 1.0})
+
+        if args.with_llm:
+            chain = create_retreival_qa_chain(llm=load_stub_llm(), retriever=flat_retriever)
+            start = time.perf_counter()
+            for query in queries:
+                chain.invoke({'input': query})
+            rows[-1]["chain_qps"] = len(queries) / (time.perf_counter() - start)
+
+        for i, config in enumerate(configs):
+            index_config = resolve_dense_index_config(**config)
+            collection_name = f"bench_{index_config['index_type'].lower()}_{i}"
+            try:
+                if collection_name not in ingest_times:
+                    ingest_times[collection_name] = load_collection(collection_name, client, documents, embed_model,
+                                                                    sparse_embed_model, index_config, env_vars)
+                retriever = convert_collection_to_retriever(collection_name=collection_name,
+                                                            env_vars=env_vars,
+                                                            embed_model=embed_model,
+                                                            sparse_embed_model=sparse_embed_model,
+                                                            k=k
+                                                            )
+                latencies, results = run_queries(retriever, queries)
+                rows.append({"config": index_config, "k": k, "ingest": ingest_times[collection_name],
+                             "latencies": latencies, "recall": recall_at_k(results, ground_truth)})
+
+            except Exception as e:
+                # e.g. index types Milvus Lite cannot build
+                rows.append({"config": index_config, "k": k, "error": str(e)})
+
+    report = []
+    print(f"\n{'index':<10} {'search params':<18} {'k':>3} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'QPS':>8} {'recall':>7}")
+    for row in rows:
+        config = row["config"]
+        if "error" in row:
+            print(f"{config['index_type']:<10} {json.dumps(config['search_params']):<18} {row['k']:>3}  skipped: {row['error'][:80]}")
+            report.append({"config": config, "k": row["k"], "error": row["error"]})
+            continue
+
+        result = {"config": config,
+                  "k": row["k"],
+                  "p50_ms": percentile_ms(row["latencies"], 50),
+                  "p95_ms": percentile_ms(row["latencies"], 95),
+                  "p99_ms": percentile_ms(row["latencies"], 99),
+                  "qps": len(row["latencies"]) / sum(row["latencies"]),
+                  "recall_at_k": row["recall"],
+                  "ingest_time": row["ingest"]
+                  }
+        if "chain_qps" in row:
+            result["chain_qps"] = row["chain_qps"]
+        report.append(result)
+
+        print(f"{config['index_type']:<10} {json.dumps(config['search_params']):<18} {row['k']:>3} "
+              f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['qps']:>8.1f} {result['recall_at_k']:>7.3f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"num_docs": args.num_docs, "num_queries": args.num_queries, "dim": args.dim, "results": report}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+'''
+Offline stand-ins for the models used by the service, shared by the benchmarks.
+
+None of them download weights or call remote endpoints, so the benchmarks run on a
+CPU-only machine without network access.
+'''
+import os
+import sys
+import random
+import hashlib
+from collections import Counter
+
+import numpy as np
+
+# Make the service modules importable when running from a source checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_milvus.utils.sparse import BaseSparseEmbedding
+
+
+def _hash_token(token, modulo):
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+    value = int.from_bytes(digest, "little")
+    return value % modulo, 1.0 if (value >> 63) & 1 else -1.0
+
+
+class HashingEmbeddings(Embeddings):
+    '''
+    Deterministic dense embedder: signed feature hashing of the lower-cased tokens, L2 normalized.
+    Texts sharing words get similar vectors, which is enough to exercise ANN search.
+    '''
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in text.lower().split():
+            index, sign = _hash_token(token, self.dim)
+            vector[index] += sign
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class HashingSparseEmbedding(BaseSparseEmbedding):
+    '''
+    Deterministic sparse embedder: term counts of hashed tokens. Stands in for BM25,
+    which needs NLTK data downloaded at runtime.
+    '''
+
+    def __init__(self, vocab_size=2 ** 20):
+        self.vocab_size = vocab_size
+
+    def _embed(self, text):
+        weights = {}
+        for token, count in Counter(text.lower().split()).items():
+            index, _ = _hash_token(token, self.vocab_size)
+            weights[index] = weights.get(index, 0.0) + float(count)
+        return weights
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def load_stub_llm(answer="This is a stub answer."):
+    '''
+    Returns a chat model that always replies with `answer`.
+    '''
+    return FakeListChatModel(responses=[answer])
+
+
+def make_vocabulary(size, seed=0):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(words)
+
+
+def make_corpus(num_docs, words_per_doc=150, vocab_size=20_000, num_topics=50, seed=0):
+    '''
+    Generates a synthetic corpus of Document objects.
+
+    Each document draws most of its words from one topic (a slice of the vocabulary)
+    and the rest from a Zipf-like background distribution, so documents of a topic
+    are near each other in embedding space.
+    '''
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocab_size, seed=seed)
+    topic_size = vocab_size // num_topics
+    background_weights = [1.0 / (rank + 1) for rank in range(vocab_size)]
+
+    documents = []
+    for doc_id in range(num_docs):
+        topic = rng.randrange(num_topics)
+        topic_words = vocabulary[topic * topic_size:(topic + 1) * topic_size]
+        num_topic_words = int(words_per_doc * 0.6)
+
+        words = rng.choices(topic_words, k=num_topic_words)
+        words += rng.choices(vocabulary, weights=background_weights, k=words_per_doc - num_topic_words)
+        rng.shuffle(words)
+
+        documents.append(Document(page_content=f"doc{doc_id} " + " ".join(words),
+                                  metadata={"source": "synthetic", "page": doc_id}
+                                  ))
+    return documents
+
+
+def make_queries(documents, num_queries, words_per_query=8, seed=1):
+    '''
+    Builds queries by sampling words from random corpus documents.
+    '''
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        words = rng.choice(documents).page_content.split()[1:]
+        queries.append(" ".join(rng.sample(words, k=min(words_per_query, len(words)))))
+    return queries
@@ -1,6 +1,12 @@
 import os
 import shutil
 import sys
+import json
+import time
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from src.logger import logger
 from src.exception import AppException
 
@@ -9,13 +15,21 @@ from dotenv import dotenv_values
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from pydantic import BaseModel
 
+# Only light modules are imported here, pymilvus, LangChain and the models are
+# loaded by `load_services` so that the API (and its liveness probe) is up first
 from src.databases.db_api import router as db_router
-from src.databases.milvus import create_milvus, convert_collection_to_retriever
-from src.ai_models.embedding import load_hf_embed_func, load_mistral_embed_func, load_sparse_embedding_func
-from src.ai_models.text_generation import load_hf_llm_model
-from src.chains.retrieval_qa_chain import create_retreival_qa_chain
+from src.chains.chain_cache import RetrievalChainCache
+from src.chains.semantic_cache import SemanticAnswerCache
+from src.utils.util import get_collection_meta_dir
+from src.utils.collection_versions import CollectionVersions
+from src.utils.concurrency import QueryLimiter
+# Same module the src packages import `span` from: as `src.utils.tracing` it would be
+# a second copy with its own current-trace context, losing the rerank and packing spans
+from utils.tracing import MetricsRegistry, RequestTrace, SlowRequestProfiler
+from src.jobs.ingestion_jobs import IngestionJobManager
 
 env_vars = dotenv_values('.env')
 
@@ -29,7 +43,19 @@ class QuestionRequest(BaseModel):
 app = FastAPI(title='QP-AI-Chatbot', 
                 version='0.0.1')
 
-app.include_router(db_router, tags=["MilvusDB"])
+
+def require_ready(request: Request):
+    '''
+    Rejects requests needing the models with a 503 until they are loaded.
+    '''
+    if not getattr(request.app, "ready", False):
+        detail = "Models are still loading"
+        if getattr(request.app, "startup_error", None):
+            detail = f"Models failed to load: {request.app.startup_error}"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+
+app.include_router(db_router, tags=["MilvusDB"], dependencies=[Depends(require_ready)])
 
 origins = ["*"]
 app.add_middleware(
@@ -40,68 +66,421 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def embed_model_kwargs(env_vars):
+    '''
+    Returns the `load_hf_embed_func` arguments configured in the environment.
+    '''
+    return {"model_name": env_vars['EMBED_MODEL_HF_PATH'],
+            "device": env_vars.get('EMBED_DEVICE', 'auto'),
+            "cache_path": env_vars.get('EMBED_CACHE_PATH'),
+            "cache_max_entries": int(env_vars.get('EMBED_CACHE_MAX_ENTRIES', 500_000)),
+            "backend": env_vars.get('EMBED_BACKEND', 'torch'),
+            "num_threads": int(env_vars.get('EMBED_NUM_THREADS', 0)) or None,
+            "max_seq_length": int(env_vars.get('EMBED_MAX_SEQ_LENGTH', 0)) or None,
+            "onnx_file_name": env_vars.get('EMBED_ONNX_FILE'),
+            "manifest_path": env_vars.get('EMBED_MANIFEST_PATH') or os.path.join(get_collection_meta_dir(env_vars), "embed_manifest.json")
+            }
+
+
+def load_services(app):
+    '''
+    Creates the milvus client, embedding func, reranker and llm, warms the models up
+    and marks the app ready.
+    '''
+    from src.databases.milvus import create_milvus
+    from src.ai_models.embedding import load_hf_embed_func, MemoizedQueryEmbeddings
+    from src.ai_models.micro_batching import MicroBatchingEmbeddings
+    from src.ai_models.embedding_server import load_remote_embed_func
+    from src.ai_models.reranker import load_cross_encoder_reranker
+    from src.ai_models.sparse_registry import SparseModelRegistry
+    from src.ai_models.text_generation import load_hf_llm_model
+
+    app.milvus_client = create_milvus(db_uri=env_vars['MILVUS_LOCAL_URI'])
+
+    logger.info("MILVUS CLIENT ADDED to app")
+
+    app.sparse_registry = SparseModelRegistry(store_dir=get_collection_meta_dir(env_vars))
+
+    logger.info("SPARSE MODEL REGISTRY ADDED to app")
+
+    # Tells the API workers when another one changed a collection
+    app.collection_versions = CollectionVersions(store_dir=get_collection_meta_dir(env_vars),
+                                                 on_change=partial(drop_collection_state, app)
+                                                 )
+
+    # The model may live in a separate embedding server process shared by the workers,
+    # whose address `python main.py --workers N` (or `--embed-server`) passes through the environment
+    embed_server_address = os.environ.get('EMBED_SERVER_ADDRESS') or env_vars.get('EMBED_SERVER_ADDRESS')
+    if embed_server_address:
+        app.dense_embed, app.embed_dim = load_remote_embed_func(
+                                                            address=embed_server_address,
+                                                            authkey=bytes.fromhex(os.environ.get('EMBED_SERVER_AUTHKEY') or env_vars['EMBED_SERVER_AUTHKEY'])
+                                                            )
+        # The server micro-batches the queries of all its clients, a second window here
+        # would only add its wait to every query
+        app.batched_embed = app.dense_embed
+    else:
+        app.dense_embed, app.embed_dim =  load_hf_embed_func(**embed_model_kwargs(env_vars))
+        # Queries of concurrent requests share one forward pass, ingestion batches only if enabled
+        app.batched_embed = MicroBatchingEmbeddings(app.dense_embed,
+                                                    max_batch_size=int(env_vars.get('EMBED_MICRO_BATCH_SIZE', 32)),
+                                                    max_wait_ms=float(env_vars.get('EMBED_MICRO_BATCH_WAIT_MS', 5)),
+                                                    batch_documents=env_vars.get('EMBED_MICRO_BATCH_DOCUMENTS', 'false').lower() == 'true'
+                                                    )
+    app.query_embed = MemoizedQueryEmbeddings(app.batched_embed)
+    app.embedder_version = f"{env_vars['EMBED_MODEL_HF_PATH']}:{env_vars.get('EMBED_BACKEND', 'torch')}"
+
+    logger.info(f"DENSE EMBEDD MODEL {env_vars['EMBED_MODEL_HF_PATH']} ADDED to app")
+
+    # Optional cross-encoder reranking of the hybrid search candidates
+    app.reranker = None
+    app.rerank_candidates = int(env_vars.get('RERANK_CANDIDATES', 20))
+    if env_vars.get('RERANK_MODEL'):
+        app.reranker = load_cross_encoder_reranker(model_name=env_vars['RERANK_MODEL'],
+                                                   device=env_vars.get('RERANK_DEVICE', 'cpu'),
+                                                   max_length=int(env_vars.get('RERANK_MAX_LENGTH', 512)),
+                                                   batch_size=int(env_vars.get('RERANK_BATCH_SIZE', 16)),
+                                                   time_budget_ms=float(env_vars.get('RERANK_BUDGET_MS', 200))
+                                                   )
+
+        logger.info(f"RERANKER {env_vars['RERANK_MODEL']} ADDED to app")
+
+    app.llm = load_hf_llm_model(hf_api_key=str(env_vars['HF_TOKEN']),
+                                model_id=env_vars['LLM_HF_PATH'],
+                                )
+
+    logger.info(f"LLM ADDED {env_vars['LLM_HF_PATH']} to app")
+
+    if env_vars.get('MODEL_WARMUP', 'true').lower() == 'true':
+        warm_up_models(app)
+
+    app.ready = True
+    logger.info("APP READY")
+
+
+def drop_collection_state(app, collection_name):
+    '''
+    Forgets the BM25 model, retrieval chains and answers held for a collection that changed.
+    '''
+    app.sparse_registry.discard(collection_name)
+    app.chain_cache.invalidate(collection_name)
+    app.answer_cache.invalidate(collection_name)
+
+
+def warm_up_models(app):
+    '''
+    Runs one inference through the embedding model and the reranker, so the first
+    question does not pay for their lazy initialization.
+    '''
+    start = time.perf_counter()
+    # Call the model behind the persistent cache, a cached vector would skip the forward pass
+    embed_model = getattr(app.dense_embed, "embed_model", app.dense_embed)
+    embed_model.embed_query("warm-up")
+    if app.reranker:
+        app.reranker.model.predict([("warm-up", "warm-up")])
+
+    logger.info(f"MODELS WARMED UP in {time.perf_counter() - start:.2f}s")
+
+
+def load_services_in_background(app):
+    try:
+        load_services(app)
+    except Exception as e:
+        app.startup_error = str(e)
+        logger.exception("Loading the models failed")
+
+
 @app.on_event("startup")
 def startup_event():
-    # Create milvus client, embedding func and llm
+    # Create the caches, job manager and metrics, then load the models
     try:
+        app.ready = False
+        app.startup_error = None
 
-        app.milvus_client = create_milvus(db_uri=env_vars['MILVUS_LOCAL_URI'])
+        app.chain_cache = RetrievalChainCache(max_size=int(env_vars.get('CHAIN_CACHE_SIZE', 32)))
 
-        logger.info("MILVUS CLIENT ADDED to app")
+        app.answer_cache = SemanticAnswerCache(threshold=float(env_vars.get('SEMANTIC_CACHE_THRESHOLD', 0.95)),
+                                               ttl_seconds=float(env_vars.get('SEMANTIC_CACHE_TTL', 3600)),
+                                               max_size=int(env_vars.get('SEMANTIC_CACHE_SIZE', 1024))
+                                               )
 
-        app.dense_embed, app.embed_dim =  load_hf_embed_func( 
-                                                                model_name=env_vars['EMBED_MODEL_HF_PATH'],
-                                                                device='cuda'
-                                                                )
-        logger.info(f"DENSE EMBEDD MODEL {env_vars['EMBED_MODEL_HF_PATH']} ADDED to app")
+        # Collection locks and job progress are shared with the other API workers through the meta dir
+        app.ingestion_jobs = IngestionJobManager(max_concurrent_jobs=int(env_vars.get('INGEST_MAX_CONCURRENT_JOBS', 2)),
+                                                 state_dir=get_collection_meta_dir(env_vars)
+                                                 )
 
-        app.llm = load_hf_llm_model(hf_api_key=str(env_vars['HF_TOKEN']),
-                                    model_id=env_vars['LLM_HF_PATH'],
-                                    )
+        app.metrics = MetricsRegistry()
+        app.profiler = None
+        if env_vars.get('PROFILE_SLOW_REQUESTS_MS'):
+            # Sample stacks while questions are answered and log those of slow ones
+            app.profiler = SlowRequestProfiler(metrics=app.metrics,
+                                               threshold_ms=float(env_vars['PROFILE_SLOW_REQUESTS_MS']),
+                                               interval_ms=float(env_vars.get('PROFILE_INTERVAL_MS', 10)),
+                                               output_dir=env_vars.get('PROFILE_OUTPUT_DIR')
+                                               )
 
-        logger.info(f"LLM ADDED {env_vars['LLM_HF_PATH']} to app")
+        app.query_limiter = QueryLimiter(max_concurrency=int(env_vars.get('QUERY_MAX_CONCURRENCY', 8)))
 
         app.env_vars = env_vars
 
+        if env_vars.get('FAST_START', 'false').lower() == 'true':
+            # Serve right away, /readyz turns 200 once the models are loaded
+            threading.Thread(target=load_services_in_background, args=(app,), name="model-loader", daemon=True).start()
+        else:
+            load_services(app)
+
     except Exception as e:
         raise AppException(e, sys)
 
+
+@app.on_event("startup")
+async def configure_executor():
+    # Sized pool for the blocking parts of the query path (embedding, Milvus search).
+    # LangChain runs sync steps of `ainvoke` in the loop's default executor.
+    app.query_executor = ThreadPoolExecutor(max_workers=int(env_vars.get('QUERY_EXECUTOR_WORKERS', 8)),
+                                            thread_name_prefix="query"
+                                            )
+    asyncio.get_running_loop().set_default_executor(app.query_executor)
+
+
 @app.get('/')
 def home():
     return "API is ready to use !"
 
 
-@app.post("/query_by_collection")
+@app.get('/healthz')
+def healthz():
+    '''
+    Liveness probe: the process is serving requests, whether or not the models are loaded.
+    '''
+    return {"status": "ok"}
+
+
+@app.get('/readyz')
+def readyz(request: Request):
+    '''
+    Readiness probe: 200 once the models are loaded, 503 while they load or if loading failed.
+    '''
+    if request.app.ready:
+        return {"status": "ready"}
+    return JSONResponse(status_code=503,
+                        content={"status": "failed" if request.app.startup_error else "loading",
+                                 "error": request.app.startup_error}
+                        )
+
+
+async def get_rag_chain(app, collection_name, k):
+    '''
+    Returns the cached RAG chain for a collection, building it in the executor on a miss.
+    '''
+    def build_chain():
+        from src.databases.milvus import convert_collection_to_retriever
+        from src.ai_models.reranker import RerankingRetriever
+        from src.chains.retrieval_qa_chain import create_retreival_qa_chain
+
+        # Convert collection into retriever
+        # With a reranker, fetch a wider candidate set and let the cross-encoder keep the best k
+        retiever = convert_collection_to_retriever(collection_name=collection_name,
+                                                     env_vars=app.env_vars, 
+                                                     embed_model=app.query_embed, 
+                                                     sparse_embed_model=app.sparse_registry.get(collection_name), 
+                                                     k=max(k, app.rerank_candidates) if app.reranker else k
+                                                     )
+        if app.reranker:
+            retiever = RerankingRetriever(base_retriever=retiever, reranker=app.reranker, top_n=k)
+        # Create Chain
+        return retiever, create_retreival_qa_chain(llm=app.llm, 
+                                                   retriever=retiever,
+                                                   context_token_budget=int(app.env_vars.get('CONTEXT_TOKEN_BUDGET', 1500)) or None,
+                                                   dedup_threshold=float(app.env_vars.get('CONTEXT_DEDUP_THRESHOLD', 0.85))
+                                                   )
+
+    # Reuse the retriever and chain built by an earlier request for the same collection and k
+    _, rag_chain = await asyncio.get_running_loop().run_in_executor(
+                                        None,
+                                        partial(app.chain_cache.get_or_create,
+                                                key=(collection_name, k, app.embedder_version),
+                                                factory=build_chain
+                                                )
+                                        )
+    return rag_chain
+
+
+async def lookup_cached_answer(app, question_request):
+    '''
+    Embeds the question and looks up the answer of a near-identical earlier question.
+
+    Returns:
+        cache_key, the cache generation to pass back to `answer_cache.add`,
+        question_embedding, and the cached response or None.
+    '''
+    # Drop the chains and answers built before another worker changed the collection
+    app.collection_versions.sync(question_request.collection_name)
+
+    cache_key = (question_request.collection_name, question_request.k)
+    generation = app.answer_cache.generation(question_request.collection_name)
+    question_embedding = await asyncio.get_running_loop().run_in_executor(None, 
+                                                                          app.query_embed.embed_query,
+                                                                          question_request.question
+                                                                          )
+    resp = app.answer_cache.lookup(cache_key, question_embedding)
+    if resp is not None:
+        # The cached response is the earlier question's, answer with the current one
+        resp = resp | {'input': question_request.question}
+    return cache_key, generation, question_embedding, resp
+
+
+@app.post("/query_by_collection", dependencies=[Depends(require_ready)])
 async def ask_question(request: Request, question_request: QuestionRequest):
+    from src.utils.trace_callbacks import TraceCallbackHandler
 
-    collection_name = question_request.collection_name
-    k=question_request.k
-    
-    # Convert collection into retriever
-    retiever = convert_collection_to_retriever(collection_name=collection_name,
-                                                 env_vars=request.app.env_vars, 
-                                                 embed_model=request.app.dense_embed, 
-                                                 sparse_embed_model=request.app.sparse_embed, 
-                                                 k=k
-                                                 )
-    
     # Log the incoming request data
-    logger.info("Received question:", question_request.question)
+    logger.info(f"Received question: {question_request.question}")
+
+    with RequestTrace(request.app.metrics, endpoint="query_by_collection", profiler=request.app.profiler) as trace:
+        queue_start = time.perf_counter()
+        async with request.app.query_limiter:
+            trace.add("queue_wait", time.perf_counter() - queue_start)
+
+            # Answer from the cache when a near-identical question was asked before
+            with trace.span("embed_question"):
+                cache_key, generation, question_embedding, resp = await lookup_cached_answer(request.app, question_request)
+            if resp is not None:
+                request.app.metrics.increment("rag_answer_cache_hits_total")
+                return resp
+
+            rag_chain = await get_rag_chain(app=request.app,
+                                            collection_name=question_request.collection_name,
+                                            k=question_request.k
+                                            )
 
-    # Create Chain
-    rag_chain = create_retreival_qa_chain(llm=request.app.llm, retriever=retiever)
+            # Run Chain without blocking the event loop
+            resp = await rag_chain.ainvoke({'input':question_request.question},
+                                           config={"callbacks": [TraceCallbackHandler(trace)]}
+                                           )
 
-    # Run Chain
-    resp = rag_chain.invoke({'input':question_request.question})
+            request.app.answer_cache.add(cache_key, question_embedding, resp, generation=generation)
     
     return resp
 
 
-# if __name__ == "__main__":
-#     uvicorn.run(app, host="localhost", port=8080)
-    
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
 
-    
 
+@app.post("/query_by_collection/stream", dependencies=[Depends(require_ready)])
+async def ask_question_stream(request: Request, question_request: QuestionRequest):
+    '''
+    Streams the answer as Server-Sent Events.
+
+    Emits one `context` event with the metadata of the retrieved chunks, then a `token` 
+    event per generated token, and a final `end` event (or `error` if the chain fails).
+    '''
+    from src.utils.trace_callbacks import TraceCallbackHandler
+
+    logger.info(f"Received question: {question_request.question}")
+
+    async def event_stream():
+        with RequestTrace(request.app.metrics, endpoint="query_by_collection_stream", profiler=request.app.profiler) as trace:
+            queue_start = time.perf_counter()
+            async with request.app.query_limiter:
+                trace.add("queue_wait", time.perf_counter() - queue_start)
+                try:
+                    with trace.span("embed_question"):
+                        cache_key, generation, question_embedding, resp = await lookup_cached_answer(request.app, question_request)
+                    if resp is not None:
+                        request.app.metrics.increment("rag_answer_cache_hits_total")
+                        yield format_sse("context", [{"metadata": doc.metadata} for doc in resp['context']])
+                        yield format_sse("token", resp['answer'])
+                        yield format_sse("end", {})
+                        return
+
+                    rag_chain = await get_rag_chain(app=request.app,
+                                                    collection_name=question_request.collection_name,
+                                                    k=question_request.k
+                                                    )
+
+                    resp = {'input': question_request.question, 'context': [], 'answer': ''}
+                    async for chunk in rag_chain.astream({'input':question_request.question},
+                                                         config={"callbacks": [TraceCallbackHandler(trace)]}
+                                                         ):
+                        if 'context' in chunk:
+                            resp['context'] = chunk['context']
+                            yield format_sse("context", [{"metadata": doc.metadata} for doc in chunk['context']])
+                        if 'answer' in chunk:
+                            resp['answer'] += chunk['answer']
+                            yield format_sse("token", chunk['answer'])
+
+                    request.app.answer_cache.add(cache_key, question_embedding, resp, generation=generation)
+                    yield format_sse("end", {})
+
+                except Exception as e:
+                    logger.exception("Streaming query failed")
+                    trace.failed = True
+                    yield format_sse("error", str(e))
+
+    return StreamingResponse(event_stream(), 
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+                             )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(request: Request):
+    '''
+    Per-stage latency histograms and request counters in the Prometheus text format.
+    '''
+    return PlainTextResponse(request.app.metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/query_stats", dependencies=[Depends(require_ready)])
+def query_stats(request: Request):
+    stats = request.app.query_limiter.stats() | {"answer_cache": request.app.answer_cache.stats()}
+    if hasattr(request.app.dense_embed, "stats"):
+        stats["embedding_cache"] = request.app.dense_embed.stats()
+    if hasattr(request.app.dense_embed, "server_stats"):
+        stats["embedding_server"] = request.app.dense_embed.server_stats()
+    if hasattr(request.app.batched_embed, "stats"):
+        stats["embedding_batching"] = request.app.batched_embed.stats()
+    if request.app.reranker:
+        stats["reranker"] = request.app.reranker.stats()
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import secrets
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Run the RAG API")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, 
+                        help="Number of API worker processes. With more than one, the embedding model "
+                             "is loaded once in a shared inference process. Milvus Lite files can only be "
+                             "opened by one process, point MILVUS_LOCAL_URI to a Milvus server instead.")
+    parser.add_argument("--embed-server", action="store_true",
+                        help="Run the embedding model in a separate inference process, so inference does "
+                             "not compete with the API for the interpreter lock. Implied by --workers > 1.")
+    args = parser.parse_args()
+
+    # Workers share collection changes, locks and job progress through the collection meta dir
+    if (args.embed_server or args.workers > 1) and not (os.environ.get('EMBED_SERVER_ADDRESS') or env_vars.get('EMBED_SERVER_ADDRESS')):
+        from src.ai_models.embedding_server import start_embedding_server
 
+        # Workers read the address and key from the environment at startup
+        address = os.path.join(tempfile.gettempdir(), f"rag-embed-{os.getpid()}.sock")
+        authkey = secrets.token_bytes(32)
+        start_embedding_server(address=address,
+                               authkey=authkey,
+                               model_kwargs=embed_model_kwargs(env_vars),
+                               max_batch_size=int(env_vars.get('EMBED_MICRO_BATCH_SIZE', 32)),
+                               max_wait_ms=float(env_vars.get('EMBED_MICRO_BATCH_WAIT_MS', 5))
+                               )
+        os.environ['EMBED_SERVER_ADDRESS'] = address
+        os.environ['EMBED_SERVER_AUTHKEY'] = authkey.hex()
 
+    if args.workers > 1:
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
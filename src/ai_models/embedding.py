@@ -1,10 +1,17 @@
+import os
 import sys
+import threading
+from collections import OrderedDict
+
 from logger import logger
 from exception import AppException
+from utils.util import read_json, write_json
 
 from mistralai import Mistral
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
 from langchain_mistralai.embeddings import MistralAIEmbeddings
+from langchain_core.embeddings import Embeddings
+from ai_models.embedding_cache import CachedEmbeddings, get_embedding_store
 # from milvus_model.hybrid import BGEM3EmbeddingFunction
 from langchain_milvus.utils.sparse import BM25SparseEmbedding
 
@@ -37,40 +44,150 @@ from langchain_milvus.utils.sparse import BM25SparseEmbedding
     
 #     return bge_m3_ef, embed_dim
 
-def load_hf_embed_func(model_name='BAAI/bge-m3', device='cpu'):
+# Embedding backends supported by `load_hf_embed_func`
+HF_EMBED_BACKENDS = ("torch", "int8", "onnx")
+
+
+def resolve_device(device=None):
+    '''
+    Returns `device`, or the best available one ("cuda", "mps" or "cpu") if it is None or "auto".
+    '''
+    if device and device != "auto":
+        return device
+
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def _onnx_model_kwargs(device, num_threads, onnx_file_name):
+    # Options passed by sentence-transformers to ONNX Runtime through optimum
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    if num_threads:
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+
+    onnx_kwargs = {"provider": "CUDAExecutionProvider" if device == "cuda" else "CPUExecutionProvider",
+                   "session_options": session_options
+                   }
+    if onnx_file_name:
+        onnx_kwargs["file_name"] = onnx_file_name
+    return {"backend": "onnx", "model_kwargs": onnx_kwargs}
+
+
+def read_embed_dim(manifest_path, model_key):
+    '''
+    Returns the embedding dimension recorded for `model_key`, or None.
+    '''
+    if not manifest_path:
+        return None
+    return (read_json(manifest_path) or {}).get(model_key)
+
+
+def record_embed_dim(manifest_path, model_key, embed_dim):
+    '''
+    Records the embedding dimension of `model_key` in the manifest.
+    '''
+    if not manifest_path:
+        return
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    write_json(manifest_path, (read_json(manifest_path) or {}) | {model_key: embed_dim})
+
+
+def load_hf_embed_func(model_name='BAAI/bge-m3', device='cpu', cache_path=None, cache_max_entries=500_000,
+                       backend="torch", num_threads=None, max_seq_length=None, onnx_file_name=None,
+                       manifest_path=None):
     '''
     Create a BGE-M3 embedding function.
 
     Args:
     model_name: The name of the model to use.
-    device: The device to use.
+    device: The device to use, "auto" (or None) picks cuda, mps or cpu.
     use_fp16: Whether to use fp16. `False` for `device='cpu'`.
+    cache_path: SQLite file of the persistent embedding cache. No cache if None.
+    cache_max_entries: Number of vectors kept in the cache.
+    backend: "torch", "int8" (PyTorch dynamic int8 quantization of the linear layers, CPU only) 
+        or "onnx" (ONNX Runtime, needs `sentence-transformers[onnx]`).
+    num_threads: Number of CPU threads used by the model. Library default if None.
+    max_seq_length: Truncate inputs to this many tokens. Model default if None.
+    onnx_file_name: ONNX file of the model repository to load, e.g. a quantized 
+        "onnx/model_qint8_avx512_vnni.onnx". Defaults to "onnx/model.onnx".
+    manifest_path: JSON file remembering the embedding dimension of each model, so later
+        starts skip the test embedding. Always embeds a test text if None.
 
     Returns:
     BGE-M3 embedding function object 
     '''
     try:
+        if backend not in HF_EMBED_BACKENDS:
+            raise ValueError(f"Unknown embedding backend {backend}, expected one of {HF_EMBED_BACKENDS}")
+
+        device = resolve_device(device)
+        if backend == "int8" and device != "cpu":
+            raise ValueError("The int8 embedding backend only runs on cpu")
+
+        model_kwargs = {'device': device}
+        if backend == "onnx":
+            model_kwargs |= _onnx_model_kwargs(device, num_threads, onnx_file_name)
+        elif num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
 
         bge_m3_ef = HuggingFaceBgeEmbeddings(model_name=model_name,
-                                             model_kwargs={'device':device},
+                                             model_kwargs=model_kwargs,
                                             )
-        logger.info("CREATED BGE-M3 embedding function")
-
-        test_embedding = bge_m3_ef.embed_documents(["This is a test"])
-        embed_dim = len(test_embedding[0])
+        if max_seq_length:
+            bge_m3_ef.client.max_seq_length = max_seq_length
+
+        if backend == "int8":
+            import torch
+            bge_m3_ef.client = torch.quantization.quantize_dynamic(bge_m3_ef.client, {torch.nn.Linear}, dtype=torch.qint8)
+
+        logger.info(f"CREATED BGE-M3 embedding function on {device} with {backend} backend")
+
+        if cache_path:
+            # Vectors of another backend or truncation differ slightly, keep them apart
+            namespace = f"hf:{model_name}"
+            if backend != "torch":
+                namespace += f":{backend}:{onnx_file_name or ''}"
+            if max_seq_length:
+                namespace += f":len{max_seq_length}"
+
+            bge_m3_ef = CachedEmbeddings(bge_m3_ef, 
+                                         store=get_embedding_store(cache_path, cache_max_entries), 
+                                         namespace=namespace
+                                         )
+
+        embed_dim = read_embed_dim(manifest_path, f"hf:{model_name}")
+        if embed_dim is None:
+            test_embedding = bge_m3_ef.embed_documents(["This is a test"])
+            embed_dim = len(test_embedding[0])
+            record_embed_dim(manifest_path, f"hf:{model_name}", embed_dim)
     
     except Exception as e:
         raise AppException(e, sys)
     
     return bge_m3_ef, embed_dim
 
-def load_mistral_embed_func(mistral_api_key):
+def load_mistral_embed_func(mistral_api_key, cache_path=None, cache_max_entries=500_000):
     
     try:
 
         mistral_embed_func = MistralAIEmbeddings(api_key=mistral_api_key)
         logger.info("CREATED Mistral embedding function")
 
+        if cache_path:
+            mistral_embed_func = CachedEmbeddings(mistral_embed_func, 
+                                                  store=get_embedding_store(cache_path, cache_max_entries), 
+                                                  namespace=f"mistral:{mistral_embed_func.model}"
+                                                  )
+
         test_embedding = mistral_embed_func.embed_documents(["This is a test"])
         embed_dim = len(test_embedding[0])
     
@@ -104,4 +221,35 @@ def load_sparse_embedding_func(data):
     except Exception as e:
         raise AppException(e, sys)
 
-    return sparse_embedding_func
\ No newline at end of file
+    return sparse_embedding_func
+
+
+class MemoizedQueryEmbeddings(Embeddings):
+    '''
+    Wraps an embedding model and remembers the most recent query embeddings, so a 
+    question embedded once (e.g. for the answer cache) is not embedded again by the retriever.
+    '''
+
+    def __init__(self, embed_model, max_size=256):
+        self.embed_model = embed_model
+        self.max_size = max_size
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        return self.embed_model.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self._lock:
+            if text in self._queries:
+                self._queries.move_to_end(text)
+                return self._queries[text]
+
+        embedding = self.embed_model.embed_query(text)
+
+        with self._lock:
+            self._queries[text] = embedding
+            while len(self._queries) > self.max_size:
+                self._queries.popitem(last=False)
+
+        return embedding
@@ -0,0 +1,185 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+from logger import logger
+
+from langchain_core.embeddings import Embeddings
+from ai_models.micro_batching import embed_queries
+
+
+class SQLiteEmbeddingStore:
+    '''
+    Persistent embedding store backed by a SQLite file, with a size cap and
+    least-recently-used eviction.
+
+    One store can be shared by several embedders and collections, keys are
+    namespaced by the caller.
+    '''
+
+    def __init__(self, db_path, max_entries=500_000):
+        '''
+        Args:
+            db_path: The SQLite file to use, created if missing.
+            max_entries: Number of vectors kept before the least recently used are evicted.
+        '''
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                           "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        logger.info(f"OPENED embedding cache {db_path} with {self._count} vectors")
+
+    def get_many(self, keys):
+        '''
+        Returns a dict of the cached vectors among `keys` and refreshes their access time.
+        '''
+        found = {}
+        with self._lock:
+            # Stay below SQLite's limit on bound parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                                          batch
+                                          ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                       [(now, key) for key in found]
+                                       )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        '''
+        Stores (key, vector) pairs, evicting the least recently used vectors above the cap.
+        '''
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                                            [(key, array("f", vector).tobytes(), now) for key, vector in items]
+                                            )
+            self._count += max(cursor.rowcount, 0)
+
+            if self._count > self.max_entries:
+                # Evict down to 90% of the cap so eviction does not run on every insert
+                excess = self._count - int(self.max_entries * 0.9)
+                self._conn.execute("DELETE FROM embeddings WHERE key IN "
+                                   "(SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                                   (excess,)
+                                   )
+                self._count -= excess
+            self._conn.commit()
+
+    def __len__(self):
+        return self._count
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_embedding_store(db_path, max_entries=500_000):
+    '''
+    Returns the store for `db_path`, opening it once per process so all embedders share it.
+    '''
+    with _stores_lock:
+        if db_path not in _stores:
+            _stores[db_path] = SQLiteEmbeddingStore(db_path=db_path, max_entries=max_entries)
+        return _stores[db_path]
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Embedding model wrapper that looks vectors up in a persistent store before
+    calling the model, keyed by (namespace, query or document, normalized text hash).
+    '''
+
+    def __init__(self, embed_model, store, namespace):
+        '''
+        Args:
+            embed_model: The wrapped LangChain embedding model.
+            store: A SQLiteEmbeddingStore.
+            namespace: Identifies the model, e.g. its name; vectors of different
+                namespaces never mix.
+        '''
+        self.embed_model = embed_model
+        self.store = store
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, kind, text):
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{self.namespace}\0{kind}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self._key("doc", text) for text in texts]
+        cached = self.store.get_many(list(set(keys)))
+
+        # Embed each missing text once, even if it repeats in the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+
+        if missing:
+            vectors = self.embed_model.embed_documents(list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            self.store.put_many(computed.items())
+            cached |= computed
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key("query", text)
+        cached = self.store.get_many([key])
+        if key in cached:
+            self.hits += 1
+            return cached[key]
+
+        self.misses += 1
+        vector = self.embed_model.embed_query(text)
+        self.store.put_many([(key, vector)])
+        return vector
+
+    def embed_queries(self, texts):
+        keys = [self._key("query", text) for text in texts]
+        cached = self.store.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+
+        if missing:
+            vectors = embed_queries(self.embed_model, list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            self.store.put_many(computed.items())
+            cached |= computed
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return [cached[key] for key in keys]
+
+    def stats(self):
+        return {"entries": len(self.store), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,186 @@
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from logger import logger
+from exception import AppException
+
+from langchain_core.embeddings import Embeddings
+
+
+def parse_address(address):
+    '''
+    Returns a `multiprocessing.connection` address: "host:port" becomes a TCP
+    address, anything else is a Unix socket path.
+    '''
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def serve_embeddings(address, authkey, model_kwargs, max_batch_size=32, max_wait_ms=5):
+    '''
+    Runs the embedding inference server: loads the dense model once and answers
+    its clients over `multiprocessing.connection`, one thread per connection.
+
+    Requests from all connections go through one MicroBatchingEmbeddings, so concurrent
+    queries share a forward pass.
+
+    Args:
+        address: "host:port" or a Unix socket path.
+        authkey: Shared secret (bytes) the clients authenticate with.
+        model_kwargs: Keyword arguments of `load_hf_embed_func`.
+        max_batch_size, max_wait_ms: Micro-batching settings.
+    '''
+    from ai_models.embedding import load_hf_embed_func
+    from ai_models.micro_batching import MicroBatchingEmbeddings
+
+    embed_model, embed_dim = load_hf_embed_func(**model_kwargs)
+    batched_embed = MicroBatchingEmbeddings(embed_model,
+                                            max_batch_size=max_batch_size,
+                                            max_wait_ms=max_wait_ms,
+                                            batch_documents=True
+                                            )
+
+    def stats():
+        stats = {"embedding_batching": batched_embed.stats()}
+        if hasattr(embed_model, "stats"):
+            stats["embedding_cache"] = embed_model.stats()
+        return stats
+
+    methods = {"embed_documents": batched_embed.embed_documents,
+               "embed_query": batched_embed.embed_query,
+               "embed_queries": batched_embed.embed_queries,
+               "info": lambda: {"embed_dim": embed_dim, "model_name": model_kwargs.get("model_name")},
+               "stats": stats
+               }
+
+    def handle(connection):
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    connection.send(("ok", methods[method](*args)))
+                except Exception as e:
+                    logger.exception(f"Embedding server failed on {method}")
+                    connection.send(("error", f"{type(e).__name__}: {e}"))
+
+    address = parse_address(address)
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)
+
+    with Listener(address, authkey=authkey) as listener:
+        logger.info(f"EMBEDDING SERVER listening on {address} with {model_kwargs.get('model_name')}")
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as e:
+                # e.g. a client failing authentication
+                logger.error(f"Embedding server rejected a connection: {e}")
+                continue
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+
+def start_embedding_server(address, authkey, model_kwargs, max_batch_size=32, max_wait_ms=5):
+    '''
+    Starts `serve_embeddings` in a separate process and returns the process.
+    '''
+    process = multiprocessing.get_context("spawn").Process(target=serve_embeddings,
+                                                           kwargs={"address": address,
+                                                                   "authkey": authkey,
+                                                                   "model_kwargs": model_kwargs,
+                                                                   "max_batch_size": max_batch_size,
+                                                                   "max_wait_ms": max_wait_ms
+                                                                   },
+                                                           name="embedding-server",
+                                                           daemon=True
+                                                           )
+    process.start()
+    logger.info(f"STARTED embedding server process {process.pid}")
+    return process
+
+
+class RemoteEmbeddings(Embeddings):
+    '''
+    Embedding model client of the embedding inference server. Each calling thread
+    keeps its own connection, re-opened if the server closed it.
+    '''
+
+    def __init__(self, address, authkey, connect_timeout=300):
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        # The server may still be loading the model, retry until the timeout
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                return Client(self.address, authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def _call(self, method, *args):
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            try:
+                connection.send((method, args))
+                status, result = connection.recv()
+                break
+            except (EOFError, OSError):
+                # Stale connection, e.g. the server restarted
+                self._local.connection = None
+                if attempt:
+                    raise
+
+        if status == "error":
+            raise RuntimeError(f"Embedding server error: {result}")
+        return result
+
+    def embed_documents(self, texts):
+        return self._call("embed_documents", texts)
+
+    def embed_query(self, text):
+        return self._call("embed_query", text)
+
+    def embed_queries(self, texts):
+        return self._call("embed_queries", texts)
+
+    def server_stats(self):
+        return self._call("stats")
+
+
+def load_remote_embed_func(address, authkey, connect_timeout=300):
+    '''
+    Connects to the embedding inference server.
+
+    Args:
+    address: "host:port" or a Unix socket path.
+    authkey: Shared secret (bytes).
+    connect_timeout: Seconds to wait for the server to come up.
+
+    Returns:
+    RemoteEmbeddings object and the embedding dimension
+    '''
+    try:
+        remote_embed = RemoteEmbeddings(address=address, authkey=authkey, connect_timeout=connect_timeout)
+        embed_dim = remote_embed._call("info")["embed_dim"]
+
+        logger.info(f"CONNECTED to embedding server at {address}")
+
+    except Exception as e:
+        raise AppException(e, sys)
+
+    return remote_embed, embed_dim
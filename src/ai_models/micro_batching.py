@@ -0,0 +1,162 @@
+import sys
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from logger import logger
+from exception import AppException
+
+from langchain_core.embeddings import Embeddings
+
+
+def embed_queries(embed_model, texts):
+    '''
+    Embeds several queries with one model call when the model allows it.
+
+    LangChain's Embeddings only has a single-query `embed_query`, which for BGE
+    models prepends the query instruction. Models exposing `embed_queries` and
+    HuggingFace BGE models are batched, anything else falls back to a loop.
+    '''
+    if hasattr(embed_model, "embed_queries"):
+        return embed_model.embed_queries(texts)
+
+    if hasattr(embed_model, "client") and hasattr(embed_model, "query_instruction"):
+        # Same preprocessing as HuggingFaceBgeEmbeddings.embed_query
+        encode_kwargs = getattr(embed_model, "query_encode_kwargs", None) or embed_model.encode_kwargs
+        embeddings = embed_model.client.encode([embed_model.query_instruction + text.replace("\n", " ") for text in texts],
+                                               **encode_kwargs
+                                               )
+        return embeddings.tolist()
+
+    return [embed_model.embed_query(text) for text in texts]
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    '''
+    Embedding model wrapper that groups the queries of concurrent callers into a
+    single model call.
+
+    The first query waits up to `max_wait_ms` for others to arrive, then all
+    pending queries (at most `max_batch_size`) are embedded in one forward pass
+    and each caller gets its own vector back. With `batch_documents`, document
+    batches of concurrent ingestions are merged the same way.
+    '''
+
+    def __init__(self, embed_model, max_batch_size=32, max_wait_ms=5, batch_documents=False):
+        '''
+        Args:
+            embed_model: The wrapped LangChain embedding model.
+            max_batch_size: Maximum number of texts per model call.
+            max_wait_ms: How long the first request of a batch waits for more.
+            batch_documents: Also route `embed_documents` through the batcher.
+        '''
+        self.embed_model = embed_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_documents = batch_documents
+
+        self._requests = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests_count = 0
+        self._texts_count = 0
+        self._max_batch = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._embed_time = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def _submit(self, kind, texts):
+        future = Future()
+        self._requests.put((kind, texts, future, time.perf_counter()))
+        return future.result()
+
+    def embed_query(self, text):
+        return self._submit("query", [text])[0]
+
+    def embed_queries(self, texts):
+        return self._submit("query", texts)
+
+    def embed_documents(self, texts):
+        if not self.batch_documents:
+            return self.embed_model.embed_documents(texts)
+        return self._submit("doc", texts)
+
+    def _collect(self):
+        # Block for the first request, then gather what arrives before the deadline
+        requests = [self._requests.get()]
+        size = len(requests[0][1])
+        deadline = time.perf_counter() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            size += len(request[1])
+
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            start = time.perf_counter()
+
+            for kind in ("query", "doc"):
+                group = [request for request in requests if request[0] == kind]
+                if group:
+                    self._embed_group(kind, group, start)
+
+    def _embed_group(self, kind, group, start):
+        texts = [text for _, request_texts, _, _ in group for text in request_texts]
+        try:
+            embed_start = time.perf_counter()
+            if kind == "query":
+                vectors = embed_queries(self.embed_model, texts)
+            else:
+                vectors = self.embed_model.embed_documents(texts)
+            embed_time = time.perf_counter() - embed_start
+
+        except Exception as e:
+            logger.error(f"FAILED to embed a batch of {len(texts)} {kind} texts: {e}")
+            error = AppException(e, sys)
+            for _, _, future, _ in group:
+                future.set_exception(error)
+            return
+
+        offset = 0
+        for _, request_texts, future, _ in group:
+            future.set_result(vectors[offset:offset + len(request_texts)])
+            offset += len(request_texts)
+
+        waits = [start - submitted for _, _, _, submitted in group]
+        with self._stats_lock:
+            self._batches += 1
+            self._requests_count += len(group)
+            self._texts_count += len(texts)
+            self._max_batch = max(self._max_batch, len(texts))
+            self._wait_time += sum(waits)
+            self._max_wait_time = max(self._max_wait_time, max(waits))
+            self._embed_time += embed_time
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._batches or 1
+            requests = self._requests_count or 1
+            return {"batches": self._batches,
+                    "requests": self._requests_count,
+                    "texts": self._texts_count,
+                    "mean_batch_size": self._texts_count / batches,
+                    "max_batch_size": self._max_batch,
+                    "mean_wait_ms": self._wait_time / requests * 1000,
+                    "max_wait_ms": self._max_wait_time * 1000,
+                    "mean_embed_ms": self._embed_time / batches * 1000,
+                    "pending": self._requests.qsize()
+                    }
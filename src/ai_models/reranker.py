@@ -0,0 +1,128 @@
+import sys
+import time
+import threading
+from typing import Any
+
+from logger import logger
+from exception import AppException
+from utils.tracing import span
+
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+
+
+class CrossEncoderReranker:
+    '''
+    Scores (query, passage) pairs with a cross-encoder and keeps the best passages.
+
+    Scoring runs in batches under a per-request time budget: when the next batch
+    would not finish in time, the candidates are returned in their original
+    (RRF) order instead.
+    '''
+
+    def __init__(self, model, batch_size=16, time_budget_ms=200):
+        '''
+        Args:
+            model: A sentence-transformers CrossEncoder.
+            batch_size: Number of pairs scored per forward pass.
+            time_budget_ms: Maximum reranking time per request.
+        '''
+        self.model = model
+        self.batch_size = batch_size
+        self.time_budget = time_budget_ms / 1000
+        self._lock = threading.Lock()
+        self.reranked = 0
+        self.fallbacks = 0
+        self.rerank_time = 0.0
+
+    def rerank(self, query, documents, top_n):
+        '''
+        Returns the `top_n` documents by cross-encoder score, or the first `top_n`
+        in their original order if the time budget runs out.
+        '''
+        if len(documents) <= 1:
+            return documents[:top_n]
+
+        with span("rerank"):
+            return self._rerank(query, documents, top_n)
+
+    def _rerank(self, query, documents, top_n):
+        start = time.perf_counter()
+        scores = []
+        batch_time = 0.0
+        for i in range(0, len(documents), self.batch_size):
+            # Stop before a batch that would not fit in what is left of the budget
+            elapsed = time.perf_counter() - start
+            if elapsed + batch_time > self.time_budget:
+                with self._lock:
+                    self.fallbacks += 1
+                logger.info(f"RERANK budget exhausted after {len(scores)}/{len(documents)} passages, keeping RRF order")
+                return documents[:top_n]
+
+            batch_start = time.perf_counter()
+            pairs = [(query, doc.page_content) for doc in documents[i:i + self.batch_size]]
+            scores.extend(float(score) for score in self.model.predict(pairs, batch_size=self.batch_size))
+            batch_time = time.perf_counter() - batch_start
+
+        ranked = sorted(zip(scores, range(len(documents))), key=lambda pair: pair[0], reverse=True)[:top_n]
+        reranked_docs = []
+        for score, index in ranked:
+            doc = documents[index]
+            doc.metadata["rerank_score"] = score
+            reranked_docs.append(doc)
+
+        with self._lock:
+            self.reranked += 1
+            self.rerank_time += time.perf_counter() - start
+
+        return reranked_docs
+
+    def stats(self):
+        with self._lock:
+            return {"reranked": self.reranked,
+                    "fallbacks": self.fallbacks,
+                    "mean_rerank_ms": self.rerank_time / max(self.reranked, 1) * 1000
+                    }
+
+
+class RerankingRetriever(BaseRetriever):
+    '''
+    Retrieves a wide candidate set with `base_retriever` and keeps the `top_n`
+    passages ranked by the cross-encoder.
+    '''
+
+    base_retriever: BaseRetriever
+    reranker: Any
+    top_n: int = 3
+
+    def _get_relevant_documents(self, query, *, run_manager: CallbackManagerForRetrieverRun):
+        candidates = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self.reranker.rerank(query, candidates, self.top_n)
+
+
+# Load a cross-encoder reranker
+def load_cross_encoder_reranker(model_name='cross-encoder/ms-marco-MiniLM-L-6-v2', device='cpu', max_length=512,
+                                batch_size=16, time_budget_ms=200):
+    '''
+    Create a cross-encoder reranker.
+
+    Args:
+    model_name: The name of the cross-encoder model, e.g. a small MiniLM or "BAAI/bge-reranker-base".
+    device: The device to use.
+    max_length: Truncate (query, passage) pairs to this many tokens.
+    batch_size: Number of pairs scored per forward pass.
+    time_budget_ms: Maximum reranking time per request.
+
+    Returns:
+    CrossEncoderReranker object
+    '''
+    try:
+        from sentence_transformers import CrossEncoder
+
+        model = CrossEncoder(model_name, device=device, max_length=max_length)
+        logger.info(f"CREATED cross-encoder reranker {model_name} on {device}")
+
+    except Exception as e:
+        raise AppException(e, sys)
+
+    return CrossEncoderReranker(model, batch_size=batch_size, time_budget_ms=time_budget_ms)
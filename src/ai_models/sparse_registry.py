@@ -0,0 +1,190 @@
+import os
+import sys
+import math
+import threading
+from collections import Counter
+
+from logger import logger
+from exception import AppException
+from utils.util import read_json, write_json
+
+from langchain_milvus.utils.sparse import BaseSparseEmbedding
+
+
+class IncrementalBM25SparseEmbedding(BaseSparseEmbedding):
+    '''
+    BM25 sparse embedding whose corpus statistics are updated as documents are added.
+
+    Documents are encoded with the BM25 term-frequency part of the score and queries
+    with the IDF part, so their inner product is the BM25 score. Term indices are
+    append-only, so vectors already stored in Milvus stay valid as the corpus grows.
+    '''
+
+    def __init__(self, language="en", k1=1.5, b=0.75, state=None):
+        '''
+        Args:
+            language: The language of the default pymilvus analyzer.
+            k1: BM25 term-frequency saturation.
+            b: BM25 document-length normalization.
+            state: Corpus statistics previously returned by `to_dict`.
+        '''
+        from pymilvus.model.sparse.bm25.tokenizers import build_default_analyzer
+        import nltk
+        nltk.download('punkt', quiet=True)
+
+        self.language = language
+        self.k1 = k1
+        self.b = b
+        self.analyzer = build_default_analyzer(language=language)
+        self._lock = threading.Lock()
+
+        state = state or {}
+        self.term_index = state.get("term_index", {})
+        self.doc_freqs = state.get("doc_freqs", {})
+        self.num_docs = state.get("num_docs", 0)
+        self.total_doc_length = state.get("total_doc_length", 0)
+
+    @property
+    def avgdl(self):
+        return self.total_doc_length / self.num_docs if self.num_docs else 1.0
+
+    def idf(self, term):
+        doc_freq = self.doc_freqs.get(term, 0)
+        return math.log(1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def add_documents(self, texts):
+        '''
+        Adds the given texts to the corpus statistics.
+        '''
+        tokenized = [self.analyzer(text) for text in texts]
+        with self._lock:
+            for terms in tokenized:
+                for term in set(terms):
+                    if term not in self.term_index:
+                        self.term_index[term] = len(self.term_index)
+                    self.doc_freqs[term] = self.doc_freqs.get(term, 0) + 1
+                self.num_docs += 1
+                self.total_doc_length += len(terms)
+
+    def remove_documents(self, texts):
+        '''
+        Removes previously added texts from the corpus statistics. Term indices are kept.
+        '''
+        tokenized = [self.analyzer(text) for text in texts]
+        with self._lock:
+            for terms in tokenized:
+                for term in set(terms):
+                    if self.doc_freqs.get(term, 0) > 0:
+                        self.doc_freqs[term] -= 1
+                self.num_docs = max(self.num_docs - 1, 0)
+                self.total_doc_length = max(self.total_doc_length - len(terms), 0)
+
+    def iter_fit(self, documents):
+        '''
+        Yields the given Document objects unchanged, adding each one to the corpus
+        statistics before it is handed on. Lets a lazy ingestion pipeline update the
+        model without materializing the document list.
+        '''
+        for doc in documents:
+            self.add_documents([doc.page_content])
+            yield doc
+
+    def embed_query(self, text):
+        term_counts = Counter(self.analyzer(text))
+        return {self.term_index[term]: self.idf(term) * count
+                for term, count in term_counts.items()
+                if term in self.term_index}
+
+    def embed_documents(self, texts):
+        avgdl = self.avgdl
+        embeddings = []
+        for text in texts:
+            terms = self.analyzer(text)
+            norm = self.k1 * (1 - self.b + self.b * len(terms) / avgdl)
+            embeddings.append({self.term_index[term]: count * (self.k1 + 1) / (count + norm)
+                               for term, count in Counter(terms).items()
+                               if term in self.term_index})
+        return embeddings
+
+    def to_dict(self):
+        with self._lock:
+            return {"language": self.language,
+                    "k1": self.k1,
+                    "b": self.b,
+                    "term_index": dict(self.term_index),
+                    "doc_freqs": dict(self.doc_freqs),
+                    "num_docs": self.num_docs,
+                    "total_doc_length": self.total_doc_length
+                    }
+
+
+class SparseModelRegistry:
+    '''
+    Keeps one BM25 sparse model per collection, persisted as JSON in `store_dir`.
+
+    Models are loaded lazily on first use, so every collection can be queried after
+    a restart without re-fitting.
+    '''
+
+    def __init__(self, store_dir, language="en"):
+        self.store_dir = store_dir
+        self.language = language
+        self._models = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, collection_name):
+        return os.path.join(self.store_dir, f"{collection_name}.bm25.json")
+
+    def get(self, collection_name):
+        '''
+        Returns the sparse model of a collection, loading it from disk if needed.
+        '''
+        with self._lock:
+            if collection_name not in self._models:
+                try:
+                    state = read_json(self._path(collection_name))
+                    if state is None:
+                        logger.info(f"NO BM25 statistics on disk for {collection_name}, starting empty")
+                        model = IncrementalBM25SparseEmbedding(language=self.language)
+                    else:
+                        model = IncrementalBM25SparseEmbedding(language=state.get("language", self.language),
+                                                               k1=state.get("k1", 1.5),
+                                                               b=state.get("b", 0.75),
+                                                               state=state
+                                                               )
+                        logger.info(f"LOADED BM25 statistics for {collection_name}")
+
+                except Exception as e:
+                    raise AppException(e, sys)
+
+                self._models[collection_name] = model
+
+            return self._models[collection_name]
+
+    def save(self, collection_name):
+        '''
+        Writes the statistics of a collection's sparse model to disk.
+        '''
+        try:
+            write_json(self._path(collection_name), self.get(collection_name).to_dict())
+            logger.info(f"SAVED BM25 statistics for {collection_name}")
+
+        except Exception as e:
+            raise AppException(e, sys)
+
+    def discard(self, collection_name):
+        '''
+        Forgets the in-memory model so the next `get` reloads the last saved state.
+        '''
+        with self._lock:
+            self._models.pop(collection_name, None)
+
+    def drop(self, collection_name):
+        '''
+        Removes a collection's sparse model from memory and disk.
+        '''
+        self.discard(collection_name)
+        if os.path.exists(self._path(collection_name)):
+            os.remove(self._path(collection_name))
@@ -0,0 +1,72 @@
+import threading
+from collections import Counter, OrderedDict
+
+from logger import logger
+
+
+class RetrievalChainCache:
+    '''
+    LRU cache of ready-to-run (retriever, chain) pairs.
+
+    Keys are tuples whose first element is the collection name, e.g.
+    (collection_name, k, embedder_version), so every entry of a collection
+    can be invalidated when the collection changes. A build that was running
+    while its collection was invalidated is returned but not cached.
+    '''
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._generations = Counter()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        '''
+        Returns the cached entry for `key`, building it with `factory()` on a miss.
+
+        Args:
+            key: A tuple starting with the collection name.
+            factory: A callable returning the value to cache.
+
+        Returns:
+            The cached value.
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            generation = self._generations[key[0]]
+
+        # Build outside the lock so a slow build does not block other collections
+        value = factory()
+
+        with self._lock:
+            if self._generations[key[0]] != generation:
+                # Invalidated during the build, the value may hold replaced models
+                return value
+
+            if key not in self._entries:
+                self._entries[key] = value
+                logger.info(f"CACHED retrieval chain for {key}")
+
+                while len(self._entries) > self.max_size:
+                    evicted_key, _ = self._entries.popitem(last=False)
+                    logger.info(f"EVICTED retrieval chain for {evicted_key}")
+
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def invalidate(self, collection_name):
+        '''
+        Drops every cached entry of a collection.
+        '''
+        with self._lock:
+            self._generations[collection_name] += 1
+            for key in [key for key in self._entries if key[0] == collection_name]:
+                del self._entries[key]
+
+        logger.info(f"INVALIDATED retrieval chains for {collection_name}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
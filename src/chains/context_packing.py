@@ -0,0 +1,93 @@
+import re
+
+from logger import logger
+from utils.tracing import span
+
+from langchain_core.documents import Document
+
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+class ContextPacker:
+    '''
+    Fits the retrieved passages into a token budget before they are stuffed into
+    the prompt.
+
+    Passages are kept in retrieval (relevance) order, near-duplicates of a passage
+    already kept are dropped, and the passage crossing the budget is truncated.
+    Tokens are counted with the LLM's tokenizer, or estimated at ~4 characters
+    per token when the model has none.
+    '''
+
+    def __init__(self, tokenizer=None, max_tokens=1500, dedup_threshold=0.85, min_passage_tokens=32):
+        '''
+        Args:
+            tokenizer: A HuggingFace tokenizer, e.g. `llm.tokenizer`.
+            max_tokens: Token budget of the whole context.
+            dedup_threshold: Word-set Jaccard similarity above which a passage is a duplicate.
+            min_passage_tokens: Do not keep a truncated passage shorter than this.
+        '''
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.dedup_threshold = dedup_threshold
+        self.min_passage_tokens = min_passage_tokens
+
+    def _encode(self, text):
+        if self.tokenizer is None:
+            return None
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def _count(self, text, token_ids):
+        return len(token_ids) if token_ids is not None else -(-len(text) // 4)
+
+    def _truncate(self, text, token_ids, num_tokens):
+        if token_ids is None:
+            return text[:num_tokens * 4]
+        return self.tokenizer.decode(token_ids[:num_tokens], skip_special_tokens=True)
+
+    def _is_duplicate(self, words, kept_words):
+        for other in kept_words:
+            union = len(words | other)
+            if union and len(words & other) / union >= self.dedup_threshold:
+                return True
+        return False
+
+    def __call__(self, documents):
+        '''
+        Returns the documents that fit the budget, the last one possibly truncated.
+        '''
+        with span("context_packing"):
+            return self._pack(documents)
+
+    def _pack(self, documents):
+        packed, kept_words = [], []
+        remaining = self.max_tokens
+        dropped_duplicates = 0
+
+        for doc in documents:
+            words = set(_WORD_PATTERN.findall(doc.page_content.lower()))
+            if self._is_duplicate(words, kept_words):
+                dropped_duplicates += 1
+                continue
+
+            token_ids = self._encode(doc.page_content)
+            # Count the separator the stuff chain puts between passages
+            num_tokens = self._count(doc.page_content, token_ids) + 2
+
+            if num_tokens > remaining:
+                if remaining - 2 >= self.min_passage_tokens:
+                    packed.append(Document(page_content=self._truncate(doc.page_content, token_ids, remaining - 2),
+                                           metadata=doc.metadata
+                                           ))
+                    remaining = 0
+                break
+
+            packed.append(doc)
+            kept_words.append(words)
+            remaining -= num_tokens
+
+        logger.info(f"PACKED {len(packed)}/{len(documents)} passages into {self.max_tokens - remaining} tokens, "
+                    f"{dropped_duplicates} near-duplicates dropped")
+
+        return packed
@@ -7,16 +7,22 @@ from exception import AppException
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
+from chains.context_packing import ContextPacker
 
 
 # function to load the RAG chain
-def create_retreival_qa_chain(llm, retriever):
+def create_retreival_qa_chain(llm, retriever, context_token_budget=None, dedup_threshold=0.85):
     """
     Runs the RAG chain with the provided LLM and retriever.
 
     Args:
         llm: The language model to use.
         retriever: The retriever to use.
+        context_token_budget: Maximum number of tokens of retrieved context in the prompt, 
+            counted with the LLM's tokenizer. No limit if None.
+        dedup_threshold: Similarity above which a retrieved passage is dropped as a 
+            near-duplicate when packing the context.
 
     Returns:
         The results of the RAG chain.
@@ -41,6 +47,15 @@ def create_retreival_qa_chain(llm, retriever):
     
     try:
         question_answer_chain = create_stuff_documents_chain(llm, prompt)
+
+        if context_token_budget:
+            # Pack the retrieved passages into the budget before they are stuffed into the prompt
+            context_packer = ContextPacker(tokenizer=getattr(llm, "tokenizer", None),
+                                           max_tokens=context_token_budget,
+                                           dedup_threshold=dedup_threshold
+                                           )
+            retriever = RunnableLambda(lambda inputs: inputs["input"]) | retriever | RunnableLambda(context_packer)
+
         rag_chain = create_retrieval_chain(retriever, question_answer_chain)
 
     except Exception as e:
@@ -0,0 +1,129 @@
+import time
+import itertools
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from logger import logger
+
+
+class SemanticAnswerCache:
+    '''
+    Answer cache looked up by question embedding similarity.
+
+    Entries are namespaced by a key whose first element is the collection name
+    (e.g. (collection_name, k)), expire after `ttl_seconds`, and are evicted
+    least-recently-used first once `max_size` entries are stored. Answers computed
+    across an invalidation of their collection are not stored, see `generation`.
+    '''
+
+    def __init__(self, threshold=0.95, ttl_seconds=3600, max_size=1024):
+        '''
+        Args:
+            threshold: Minimum cosine similarity between questions for a hit.
+            ttl_seconds: Lifetime of an entry.
+            max_size: Maximum number of entries across all namespaces.
+        '''
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._ids = itertools.count()
+        self._lru = OrderedDict()      # entry id -> namespace
+        self._namespaces = {}          # namespace -> {entry id: (vector, answer, expires_at)}
+        self._generations = Counter()  # collection name -> number of invalidations
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        namespace = self._lru.pop(entry_id)
+        entries = self._namespaces[namespace]
+        del entries[entry_id]
+        if not entries:
+            del self._namespaces[namespace]
+
+    def lookup(self, namespace, embedding):
+        '''
+        Returns the cached answer of the most similar earlier question in `namespace`
+        if its similarity reaches the threshold, otherwise None.
+        '''
+        query = self._normalize(embedding)
+        now = time.time()
+
+        with self._lock:
+            entries = self._namespaces.get(namespace, {})
+            for entry_id in [entry_id for entry_id, entry in entries.items() if entry[2] < now]:
+                self._remove(entry_id)
+
+            entries = self._namespaces.get(namespace)
+            if not entries:
+                self.misses += 1
+                return None
+
+            entry_ids = list(entries)
+            similarities = np.stack([entries[entry_id][0] for entry_id in entry_ids]) @ query
+            best = int(np.argmax(similarities))
+
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._lru.move_to_end(entry_ids[best])
+            return entries[entry_ids[best]][1]
+
+    def generation(self, collection_name):
+        '''
+        Returns the current generation of a collection, to be captured before
+        computing an answer and passed to `add`.
+        '''
+        with self._lock:
+            return self._generations[collection_name]
+
+    def add(self, namespace, embedding, answer, generation=None):
+        '''
+        Stores an answer under the embedding of its question.
+
+        If `generation` is given and the collection was invalidated since it was
+        captured, the answer may come from replaced documents and is dropped.
+        '''
+        with self._lock:
+            if generation is not None and generation != self._generations[namespace[0]]:
+                logger.info(f"SKIPPED caching an answer for {namespace[0]}, invalidated meanwhile")
+                return
+
+            entry_id = next(self._ids)
+            self._namespaces.setdefault(namespace, {})[entry_id] = (self._normalize(embedding),
+                                                                    answer,
+                                                                    time.time() + self.ttl_seconds
+                                                                    )
+            self._lru[entry_id] = namespace
+
+            while len(self._lru) > self.max_size:
+                self._remove(next(iter(self._lru)))
+
+    def invalidate(self, collection_name):
+        '''
+        Drops every entry of a collection.
+        '''
+        with self._lock:
+            self._generations[collection_name] += 1
+            for entry_id in [entry_id for entry_id, namespace in self._lru.items() if namespace[0] == collection_name]:
+                self._remove(entry_id)
+
+        logger.info(f"INVALIDATED cached answers for {collection_name}")
+
+    def stats(self):
+        return {"entries": len(self._lru),
+                "hits": self.hits,
+                "misses": self.misses,
+                "threshold": self.threshold
+                }
@@ -1,95 +1,255 @@
-import os
-import shutil
 import sys
+import json
+from typing import List, Literal
 
 from logger import logger
 from exception import AppException
-from utils.util import save_uploaded_file
+from utils.util import SpooledUpload, get_collection_meta_dir
 
-from extraction.pdf import langchain_pdf_loader
-from databases.milvus import create_or_load_collection, add_documents_to_collection
-from ai_models.embedding import load_hf_embed_func, load_sparse_embedding_func
+# `databases.milvus` and `databases.ingestion` pull in pymilvus and LangChain,
+# the handlers import them so the router does not slow down the API start
 
-from fastapi import APIRouter, UploadFile, Request, HTTPException, File, Form
+from fastapi import APIRouter, UploadFile, Request, HTTPException, File, Form, Depends
 from pydantic import BaseModel
 
 class UploadRequest(BaseModel):
     collection_name: str
     chunk_size: int = 1000
     overlap:int = 200
+    dense_batch_size: int = 32
+    sparse_batch_size: int = 256
+    extraction_workers: int = 1
+    chunking: Literal["recursive", "char", "token"] = "recursive"
+    insert_batch_bytes: int = 8 * 2**20
+    columnar_insert: bool = False
+    replace: bool = False
+    index_type: str = "FLAT"
+    index_params: dict = {}
+    search_params: dict = {}
+
+class ReindexRequest(BaseModel):
+    collection_name: str
+    index_type: str = "HNSW"
+    index_params: dict = {}
+    search_params: dict = {}
 
 router = APIRouter()
 
+TEMP_DIR = "temp"
+PDF_EXTENSIONS = (".pdf",)
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+# Upload settings shared by /upload and /upload_batch, sent as form fields
+def upload_request_form(collection_name: str = Form(example='annual_report'),
+                        chunk_size: int = Form(example=1000),
+                        overlap:int = Form(example=200),
+                        dense_batch_size: int = Form(default=32),
+                        sparse_batch_size: int = Form(default=256),
+                        extraction_workers: int = Form(default=1),
+                        chunking: Literal["recursive", "char", "token"] = Form(default="recursive"),
+                        insert_batch_bytes: int = Form(default=8 * 2**20),
+                        columnar_insert: bool = Form(default=False),
+                        replace: bool = Form(default=False),
+                        index_type: str = Form(default="FLAT"),
+                        index_params: str = Form(default="{}", example='{"M": 16, "efConstruction": 200}'),
+                        search_params: str = Form(default="{}", example='{"ef": 64}'),
+                        ):
+    from databases.milvus import resolve_dense_index_config
+
+    try:
+        upload_req = UploadRequest(collection_name=collection_name,
+                                   chunk_size=chunk_size,
+                                   overlap=overlap,
+                                   dense_batch_size=dense_batch_size,
+                                   sparse_batch_size=sparse_batch_size,
+                                   extraction_workers=extraction_workers,
+                                   chunking=chunking,
+                                   insert_batch_bytes=insert_batch_bytes,
+                                   columnar_insert=columnar_insert,
+                                   replace=replace,
+                                   index_type=index_type,
+                                   index_params=json.loads(index_params),
+                                   search_params=json.loads(search_params)
+                                   )
+        # Reject an unknown index type before the upload is accepted rather than in the job
+        resolve_dense_index_config(index_type=upload_req.index_type,
+                                   index_params=upload_req.index_params,
+                                   search_params=upload_req.search_params
+                                   )
+
+    # Invalid JSON and validation errors of the params are ValueErrors
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid upload settings: {e}")
+
+    return upload_req
+
+
 @router.post("/upload")
 async def upload_file(request: Request,
                       file: UploadFile = File(...),
-                      collection_name: str = Form(example='annual_report'),
-                      chunk_size: int = Form(example=1000),
-                      overlap:int = Form(example=200),
+                      upload_req: UploadRequest = Depends(upload_request_form),
                       ):
     '''
-    Uploads a PDF file, chunks it, generates embeddings, and stores it in Milvus.
+    Uploads a PDF file and queues a background job that chunks it, generates embeddings, 
+    and stores it in Milvus. Poll `/jobs/{job_id}` for progress.
     
     Args:
-        upload_req : pydantic Request object.
+        upload_req : pydantic Request object, sent as form fields:
+            extraction_workers: Number of processes extracting pages, 1 extracts in the request.
+            chunking: "recursive" (LangChain separators), or the faster "char" / "token" offset chunking.
+            insert_batch_bytes: Approximate payload size of one Milvus insert.
+            columnar_insert: Insert column arrays instead of row dicts.
+            replace: Replace a stored file of the same name whose content differs (a revision). 
+                Without it, such an upload fails, as it may be a different document.
+            index_type, index_params, search_params: Dense index config (params as JSON strings), 
+                only used when the collection is created.
         request (Request): FastAPI Request object.
         file (UploadFile, optional): The uploaded PDF file. Defaults to File(...).
 
     Returns:
-        dict: A dictionary containing a success message or an error message. 
-               e.g., {"message": "File uploaded and processed successfully"}
+        dict: A dictionary containing a success message and the job id. 
+               e.g., {"message": "Document accepted for ingestion!", "job_id": "...", "status_url": "/jobs/..."}
     '''
-    upload_req = UploadRequest(collection_name=collection_name,
-                               chunk_size=chunk_size,
-                               overlap=overlap
-                               )
+    from databases.ingestion import ingest_pdf
+
+    if file.filename.split(".")[-1] != "pdf":
+        raise HTTPException(status_code=400, detail="File must be a PDF")
 
     try:
-        if file.filename.split(".")[-1] != "pdf":
-            raise HTTPException(status_code=400, detail="File must be a PDF")
-
-        # Save the uploaded file to a temporary directory
-        save_uploaded_file(file=file)
-
-        logger.info("File saved to temporary directory")
-
-        # Chunk the file
-        documents = langchain_pdf_loader(file_path=f"./temp/{file.filename}",
-                                         chunk_size=upload_req.chunk_size,
-                                         overlap=upload_req.overlap
-                                         )
-        logger.info("File chunked")
-
-        # initialize milvus collection
-        collection_status = create_or_load_collection(collection_name = upload_req.collection_name, 
-                                                        client = request.app.milvus_client, 
-                                                        embed_dim = request.app.embed_dim
-                                                        )
-        logger.info(collection_status)
-
-        # Create a sparse embedding functions
-        sparse_embed = load_sparse_embedding_func(documents)
-        request.app.sparse_embed = sparse_embed
-        
-        # Push the documents and embeddings to collection
-        status = add_documents_to_collection(collection_name = upload_req.collection_name, 
-                                                client = request.app.milvus_client, 
-                                                embed_model = request.app.dense_embed, 
-                                                sparse_embed_model = request.app.sparse_embed,
-                                                documents = documents,
-                                                batch_size=5,
+        # Keep the upload readable after the response, the request's upload 
+        # stream is closed once it is sent
+        upload = SpooledUpload.from_upload(file=file, temp_dir=TEMP_DIR)
+
+        job = request.app.ingestion_jobs.submit(func=lambda job: ingest_pdf(app=request.app, 
+                                                                            upload_req=upload_req, 
+                                                                            upload=upload, 
+                                                                            source=file.filename, 
+                                                                            job=job
+                                                                            ),
+                                                description={"filename": file.filename,
+                                                             "collection_name": upload_req.collection_name},
+                                                cleanup=upload.close
                                                 )
 
-        # Remove the temporary file\
-        os.remove(f"./temp/{file.filename}")
-        
-        logger.info("Temporary file removed")
+    except Exception as e:
+        raise AppException(e, sys)
+
+    return {"message": "Document accepted for ingestion!",
+            "job_id": job.job_id,
+            "status_url": f"/jobs/{job.job_id}"
+            }
+
+
+@router.post("/upload_batch")
+async def upload_batch(request: Request,
+                       files: List[UploadFile] = File(...),
+                       upload_req: UploadRequest = Depends(upload_request_form),
+                       ):
+    '''
+    Uploads several PDF files and/or zip/tar archives of PDF files and queues them 
+    as a single ingestion job: the job unpacks the archives, the collection is loaded 
+    once, embedding batches are shared across files and the sparse model is updated 
+    once. The job result lists the status of every PDF file.
+
+    Archives are limited to INGEST_ARCHIVE_MAX_MEMBERS members and INGEST_ARCHIVE_MAX_BYTES 
+    of uncompressed PDF files, a larger archive fails the job.
+
+    Args:
+        request (Request): FastAPI Request object.
+        files (List[UploadFile]): PDF files, or .zip / .tar / .tar.gz / .tgz archives.
+        upload_req : pydantic Request object, sent as form fields as for `/upload`.
+
+    Returns:
+        dict: The job id and the accepted file names.
+    '''
+    from databases.ingestion import ingest_upload_batch
+
+    for file in files:
+        if not file.filename.lower().endswith(PDF_EXTENSIONS + ARCHIVE_EXTENSIONS):
+            raise HTTPException(status_code=400, detail=f"{file.filename} is not a PDF or a zip/tar archive")
 
-        return {"message": "Document uploaded successfully!"} | status
+    # Archives are unpacked by the job, decompressing here would block the event loop
+    uploads = []
+    try:
+        for file in files:
+            uploads.append((SpooledUpload.from_upload(file=file, temp_dir=TEMP_DIR), file.filename))
 
     except Exception as e:
+        close_uploads(uploads)
         raise AppException(e, sys)
 
+    env_vars = request.app.env_vars
+    job = request.app.ingestion_jobs.submit(func=lambda job: ingest_upload_batch(app=request.app,
+                                                                                 upload_req=upload_req,
+                                                                                 uploads=uploads,
+                                                                                 job=job,
+                                                                                 temp_dir=TEMP_DIR,
+                                                                                 max_archive_members=int(env_vars.get('INGEST_ARCHIVE_MAX_MEMBERS', 1000)),
+                                                                                 max_archive_bytes=int(env_vars.get('INGEST_ARCHIVE_MAX_BYTES', 2**30))
+                                                                                 ),
+                                            description={"filenames": [file_name for _, file_name in uploads],
+                                                         "collection_name": upload_req.collection_name},
+                                            cleanup=lambda: close_uploads(uploads)
+                                            )
+
+    return {"message": f"{len(uploads)} files accepted for ingestion!",
+            "files": [file_name for _, file_name in uploads],
+            "job_id": job.job_id,
+            "status_url": f"/jobs/{job.job_id}"
+            }
+
+
+def close_uploads(files):
+    for upload, _ in files:
+        upload.close()
+
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str, request: Request):
+    '''
+    Reports the stage, chunks processed, throughput and ETA of an ingestion job.
+    '''
+    job = request.app.ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+@router.get("/jobs")
+def list_jobs(request: Request):
+    return {"jobs": [job.to_dict() for job in request.app.ingestion_jobs.list()]}
+
+
+@router.post("/reindex_collection")
+def reindex(request: Request, reindex_req: ReindexRequest):
+    '''
+    Rebuilds the dense index of an existing collection with a new index type and parameters.
+
+    Waits for running ingestions of the collection to finish first.
+    '''
+    from databases.milvus import reindex_collection, resolve_dense_index_config
+
+    try:
+        index_config = resolve_dense_index_config(index_type=reindex_req.index_type,
+                                                  index_params=reindex_req.index_params,
+                                                  search_params=reindex_req.search_params
+                                                  )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    with request.app.ingestion_jobs.collection_lock(reindex_req.collection_name):
+        if not request.app.milvus_client.has_collection(reindex_req.collection_name):
+            raise HTTPException(status_code=404, detail=f"Collection {reindex_req.collection_name} not found")
+
+        status = reindex_collection(collection_name=reindex_req.collection_name,
+                                    client=request.app.milvus_client,
+                                    index_config=index_config,
+                                    meta_dir=get_collection_meta_dir(request.app.env_vars)
+                                    )
+        request.app.collection_versions.bump(reindex_req.collection_name)
+
+    return status
+
 
 @router.get("/list_collections")
 def get_collections(request: Request):
@@ -98,6 +258,18 @@ def get_collections(request: Request):
 
 @router.get('/delete_collection/{collection_name}')
 def delete_collection(collection_name: str, request: Request):
-    request.app.milvus_client.drop_collection(collection_name)
+    '''
+    Drops a collection with its BM25 model and source manifest.
+
+    Waits for running ingestions of the collection to finish first, so they
+    cannot write the BM25 model or manifest back after the drop.
+    '''
+    from databases.milvus import drop_source_manifest
+
+    with request.app.ingestion_jobs.collection_lock(collection_name):
+        request.app.milvus_client.drop_collection(collection_name)
+        request.app.sparse_registry.drop(collection_name)
+        drop_source_manifest(get_collection_meta_dir(request.app.env_vars), collection_name)
+        request.app.collection_versions.bump(collection_name)
     return {"message": "Collection deleted successfully!",
             "collections": request.app.milvus_client.list_collections()}
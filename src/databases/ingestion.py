@@ -0,0 +1,431 @@
+import time
+import tarfile
+import zipfile
+
+from logger import logger
+from utils.util import get_collection_meta_dir, SpooledUpload
+
+from extraction.pdf import lazy_langchain_pdf_loader, parallel_pdf_loader, pypdf_loader
+from databases.milvus import (create_or_load_collection, add_documents_to_collection, resolve_dense_index_config, 
+                              file_content_hash, ChunkDeduplicator, load_source_manifest, save_source_manifest)
+
+
+# Pick the PDF loader matching the upload settings
+def load_pdf_chunks(upload, source, upload_req):
+    '''
+    Lazily yields the chunks of an uploaded PDF file.
+
+    Single-process extraction reads the upload's buffer directly, only the 
+    process pool needs the content written to a file.
+
+    Args:
+        upload: SpooledUpload holding the PDF file.
+        source: The original file name, stored as the chunks' source.
+        upload_req: UploadRequest with the chunking and extraction settings.
+    '''
+    if upload_req.extraction_workers > 1:
+        yield from parallel_pdf_loader(file_path=upload.file_path(),
+                                       chunk_size=upload_req.chunk_size,
+                                       overlap=upload_req.overlap,
+                                       num_workers=upload_req.extraction_workers,
+                                       chunking=upload_req.chunking,
+                                       source=source
+                                       )
+        return
+
+    with upload.open() as stream:
+        if upload_req.chunking != "recursive":
+            yield from pypdf_loader(file_path=stream,
+                                    chunk_size=upload_req.chunk_size,
+                                    overlap=upload_req.overlap,
+                                    chunking=upload_req.chunking,
+                                    source=source
+                                    )
+        else:
+            yield from lazy_langchain_pdf_loader(file_path=stream,
+                                                 chunk_size=upload_req.chunk_size,
+                                                 overlap=upload_req.overlap,
+                                                 source=source
+                                                 )
+
+
+def count_pdf_pages(upload):
+    from pypdf import PdfReader
+
+    with upload.open() as stream:
+        return len(PdfReader(stream).pages)
+
+
+def _track_pages(documents, job, pages_offset=0):
+    # Report the last page reached, used for the job's ETA
+    for doc in documents:
+        job.update(pages_done=pages_offset + doc.metadata.get("page", 0) + 1)
+        yield doc
+
+
+class _FileState:
+    '''
+    Ingestion state and status of one file of a run.
+    '''
+
+    def __init__(self, upload, source):
+        self.upload = upload
+        self.source = source
+        self.status = "pending"
+        self.error = None
+        self.file_hash = None
+        self.deduplicator = None
+        self.pages = 0
+        self.new_chunks = 0
+
+    def to_dict(self):
+        status = {"source": self.source, "status": self.status}
+        if self.deduplicator is not None:
+            status |= {"file_hash": self.file_hash,
+                       "new_chunks": self.new_chunks,
+                       "skipped_chunks": self.deduplicator.skipped,
+                       "deleted_chunks": self.deduplicator.deleted
+                       }
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+
+def _iter_new_chunks(states, upload_req, job):
+    '''
+    Chains the new chunks of every pending file. A file that fails to load is 
+    marked failed and the run moves on to the next one.
+    '''
+    pages_offset = 0
+    for state in states:
+        if state.status != "pending":
+            continue
+        try:
+            chunks = _track_pages(load_pdf_chunks(state.upload, state.source, upload_req), job, pages_offset)
+            for doc in state.deduplicator.filter_new(chunks):
+                state.new_chunks += 1
+                yield doc
+            state.status = "ingested"
+
+        except Exception as e:
+            state.status = "failed"
+            state.error = str(e)
+            logger.error(f"FAILED to load {state.source}: {e}")
+
+        pages_offset += state.pages
+
+
+# Run the whole ingestion of one or more PDF files
+def ingest_pdfs(app, upload_req, files, job=None):
+    '''
+    Chunks PDF files, embeds the chunks that are new for each source and stores them 
+    in Milvus as one run: the collection is loaded once, embedding and insert batches 
+    are shared across files and the sparse model is saved once at the end.
+
+    Args:
+        app: The FastAPI app holding the Milvus client, models, registries and caches.
+        upload_req: UploadRequest with the collection, chunking and batching settings.
+        files: List of (upload, source) pairs: a SpooledUpload and the original 
+            file name, used to deduplicate re-uploads.
+        job: Optional IngestionJob receiving progress updates.
+
+    Returns:
+        dict: The per-file status, insert status and time taken.
+    '''
+    job = job or _NoJob()
+
+    # Runs on one collection share its BM25 model and source records, and compare uploads 
+    # with the stored chunks, so they must not overlap, also across API workers
+    job.update(stage="waiting for collection")
+    with app.ingestion_jobs.collection_lock(upload_req.collection_name):
+        # Start from the BM25 statistics another worker may have saved meanwhile
+        app.collection_versions.sync(upload_req.collection_name)
+        return _ingest_pdfs(app, upload_req, files, job)
+
+
+def _ingest_pdfs(app, upload_req, files, job):
+    start_time = time.time()
+
+    # initialize milvus collection
+    job.update(stage="preparing")
+    meta_dir = get_collection_meta_dir(app.env_vars)
+    collection_status = create_or_load_collection(collection_name = upload_req.collection_name, 
+                                                    client = app.milvus_client, 
+                                                    embed_dim = app.embed_dim,
+                                                    index_config = resolve_dense_index_config(index_type=upload_req.index_type,
+                                                                                              index_params=upload_req.index_params,
+                                                                                              search_params=upload_req.search_params
+                                                                                              ),
+                                                    meta_dir = meta_dir
+                                                    )
+    collection_end_time = time.time()
+    logger.info(collection_status)
+
+    source_manifest = load_source_manifest(meta_dir, upload_req.collection_name)
+
+    states = [_FileState(upload, source) for upload, source in files]
+    seen_sources = set()
+    for state in states:
+        if state.source in seen_sources:
+            state.status = "failed"
+            state.error = "Duplicate file name in the upload"
+            continue
+        seen_sources.add(state.source)
+
+        try:
+            # Compare the upload with what is already stored for this file name. The chunking 
+            # settings are part of the hash since changing them changes every chunk.
+            with state.upload.open() as stream:
+                state.file_hash = file_content_hash(stream,
+                                                    salt=f"{upload_req.chunk_size}:{upload_req.overlap}:{upload_req.chunking}:"
+                                                    )
+            state.deduplicator = ChunkDeduplicator(collection_name=upload_req.collection_name,
+                                                   client=app.milvus_client,
+                                                   source=state.source,
+                                                   file_hash=state.file_hash,
+                                                   record=source_manifest.get(state.source)
+                                                   )
+            if state.deduplicator.is_unchanged():
+                logger.info(f"{state.source} is already in {upload_req.collection_name}, skipping")
+                state.status = "unchanged"
+                continue
+
+            # The stale chunks of a revision are deleted, never do that to another document by accident
+            if state.deduplicator.conflicts() and not upload_req.replace:
+                state.status = "failed"
+                state.error = (f"A different file named {state.source} is already stored in {upload_req.collection_name}, "
+                               f"upload with replace=true to replace it or rename the file")
+                continue
+
+            state.pages = count_pdf_pages(state.upload)
+
+        except Exception as e:
+            state.status = "failed"
+            state.error = str(e)
+            logger.error(f"FAILED to prepare {state.source}: {e}")
+
+    pending = [state for state in states if state.status == "pending"]
+    if not pending:
+        return {"message": "Nothing to ingest!", 
+                "files": [state.to_dict() for state in states]
+                }
+
+    # Until the run completes, the stored chunks of these sources mix two versions
+    for state in pending:
+        source_manifest[state.source] = state.deduplicator.to_record(complete=False)
+    save_source_manifest(meta_dir, upload_req.collection_name, source_manifest)
+
+    # Load the collection's sparse model, its statistics are updated as chunks stream in
+    sparse_embed = app.sparse_registry.get(upload_req.collection_name)
+
+    # Chunk the files lazily, page by page. Only chunks not stored yet are embedded 
+    # and counted in the BM25 statistics.
+    job.update(stage="embedding", pages_total=sum(state.pages for state in pending))
+    documents = sparse_embed.iter_fit(_iter_new_chunks(pending, upload_req, job))
+    
+    # Push the documents and embeddings to collection
+    try:
+        status = add_documents_to_collection(collection_name = upload_req.collection_name, 
+                                                client = app.milvus_client, 
+                                                embed_model = app.batched_embed, 
+                                                sparse_embed_model = sparse_embed,
+                                                documents = documents,
+                                                batch_size=None,
+                                                insert_batch_bytes=upload_req.insert_batch_bytes,
+                                                columnar=upload_req.columnar_insert,
+                                                db_uri=app.env_vars['MILVUS_LOCAL_URI'],
+                                                dense_batch_size=upload_req.dense_batch_size,
+                                                sparse_batch_size=upload_req.sparse_batch_size,
+                                                progress_callback=job.update
+                                                )
+        # Remove chunks that disappeared from revised files. Failed files may 
+        # have been read only partially, their stored chunks are kept.
+        job.update(stage="finalizing")
+        for state in pending:
+            if state.status == "ingested":
+                sparse_embed.remove_documents(state.deduplicator.delete_stale())
+
+    except Exception:
+        _roll_back(app, upload_req.collection_name, pending)
+        raise
+
+    app.sparse_registry.save(upload_req.collection_name)
+
+    # Only files read to the end are complete, a re-upload of the others resumes them
+    for state in pending:
+        if state.status == "ingested":
+            source_manifest[state.source] = state.deduplicator.to_record(complete=True)
+    save_source_manifest(meta_dir, upload_req.collection_name, source_manifest)
+
+    app.collection_versions.bump(upload_req.collection_name)
+    logger.info(f"{len(pending)} files chunked and added to collection {upload_req.collection_name}")
+
+    status["files"] = [state.to_dict() for state in states]
+    status["time_taken"] |= {"to_create_or_load_collection": collection_end_time - start_time,
+                             "total": time.time() - start_time
+                             }
+
+    return {"message": "Documents uploaded successfully!"} | status
+
+
+def _roll_back(app, collection_name, states):
+    '''
+    Undoes a failed run: deletes the rows it inserted, then reloads the last saved BM25 
+    statistics. When the rows cannot be identified (collections without hash fields) or 
+    deleting them fails, the statistics are saved instead, so the term indices of the 
+    sparse vectors left in Milvus stay assigned to the same terms.
+    '''
+    try:
+        rows_deleted = all([state.deduplicator.delete_inserted() for state in states])
+    except Exception as e:
+        logger.error(f"FAILED to delete the rows of the failed run from {collection_name}: {e}")
+        rows_deleted = False
+
+    if rows_deleted:
+        app.sparse_registry.discard(collection_name)
+    else:
+        app.sparse_registry.save(collection_name)
+
+    # Cached retrievers, here and in other workers, hold the sparse model that was just replaced
+    app.collection_versions.bump(collection_name)
+
+
+def ingest_pdf(app, upload_req, upload, source, job=None):
+    '''
+    Ingests a single PDF file, see `ingest_pdfs`.
+
+    Returns:
+        dict: The insert status, deduplication counts and time taken.
+    '''
+    status = ingest_pdfs(app=app, upload_req=upload_req, files=[(upload, source)], job=job)
+    file_status = status.pop("files")[0]
+
+    if file_status["status"] == "unchanged":
+        return {"message": "Document already uploaded, nothing to do!", "file_hash": file_status["file_hash"]}
+    if file_status["status"] == "failed":
+        raise RuntimeError(file_status["error"])
+
+    status["message"] = "Document uploaded successfully!"
+    status["deduplication"] = {"file_hash": file_status["file_hash"],
+                               "skipped_chunks": file_status["skipped_chunks"],
+                               "deleted_chunks": file_status["deleted_chunks"]
+                               }
+    return status
+
+
+# Ingest uploaded PDF files and archives of PDF files
+def ingest_upload_batch(app, upload_req, uploads, job=None, temp_dir="temp", 
+                        max_archive_members=1000, max_archive_bytes=2**30):
+    '''
+    Unpacks the zip/tar archives among the uploads and ingests all PDF files as one 
+    run, see `ingest_pdfs`. Runs in the ingestion job, so decompression never 
+    blocks the request handlers.
+
+    Args:
+        app: The FastAPI app.
+        upload_req: UploadRequest with the collection, chunking and batching settings.
+        uploads: List of (upload, file_name) pairs of PDF files and archives.
+        job: Optional IngestionJob receiving progress updates.
+        temp_dir: Where large archive members are spilled.
+        max_archive_members, max_archive_bytes: Limits of each archive, see `extract_pdf_archive`.
+
+    Returns:
+        dict: The result of `ingest_pdfs`.
+    '''
+    job = job or _NoJob()
+    job.update(stage="unpacking")
+
+    files, extracted = [], []
+    try:
+        for upload, file_name in uploads:
+            if file_name.lower().endswith(".pdf"):
+                files.append((upload, file_name))
+                continue
+
+            with upload.open() as archive:
+                members = extract_pdf_archive(archive, file_name, 
+                                              temp_dir=temp_dir, 
+                                              max_members=max_archive_members, 
+                                              max_total_bytes=max_archive_bytes
+                                              )
+            extracted.extend(members)
+            files.extend(members)
+
+        if not files:
+            raise ValueError("No PDF files found in the upload")
+
+        return ingest_pdfs(app=app, upload_req=upload_req, files=files, job=job)
+
+    finally:
+        for upload, _ in extracted:
+            upload.close()
+
+
+# Unpack the PDF files of a zip or tar archive
+def extract_pdf_archive(archive, archive_name, temp_dir="temp", max_members=1000, max_total_bytes=2**30):
+    '''
+    Reads the PDF members of a zip or tar archive into SpooledUploads, without 
+    writing them to the file system (unless a member is too large for memory).
+
+    Args:
+        archive: The .zip, .tar, .tar.gz or .tgz file as a binary file object.
+        archive_name: The archive's file name, used in messages.
+        temp_dir: Where large members are spilled.
+        max_members: Maximum number of members (of any type) in the archive.
+        max_total_bytes: Maximum uncompressed size of its PDF members together. The 
+            readers stop at the sizes declared by the archive, so checking them is enough.
+
+    Returns:
+        A list of (upload, member_name) pairs, in archive order.
+    '''
+    is_zip = zipfile.is_zipfile(archive)
+    archive.seek(0)
+    is_tar = not is_zip and tarfile.is_tarfile(archive)
+    archive.seek(0)
+
+    members = []
+    total_bytes = 0
+
+    def check_limits(num_members, member_bytes):
+        nonlocal total_bytes
+        total_bytes += member_bytes
+        if num_members > max_members:
+            raise ValueError(f"{archive_name} has more than {max_members} members")
+        if total_bytes > max_total_bytes:
+            raise ValueError(f"The PDF files of {archive_name} exceed {max_total_bytes} bytes uncompressed")
+
+    try:
+        if is_zip:
+            with zipfile.ZipFile(archive) as zip_file:
+                infos = zip_file.infolist()
+                check_limits(len(infos), 0)
+                for info in infos:
+                    if not info.is_dir() and info.filename.lower().endswith(".pdf"):
+                        check_limits(len(infos), info.file_size)
+                        with zip_file.open(info) as member:
+                            members.append((SpooledUpload.from_stream(member, info.filename, temp_dir=temp_dir), info.filename))
+
+        elif is_tar:
+            with tarfile.open(fileobj=archive) as tar_file:
+                for num_members, info in enumerate(tar_file, start=1):
+                    is_pdf = info.isfile() and info.name.lower().endswith(".pdf")
+                    check_limits(num_members, info.size if is_pdf else 0)
+                    if is_pdf:
+                        with tar_file.extractfile(info) as member:
+                            members.append((SpooledUpload.from_stream(member, info.name, temp_dir=temp_dir), info.name))
+
+        else:
+            raise ValueError(f"{archive_name} is not a zip or tar archive")
+
+    except Exception:
+        for upload, _ in members:
+            upload.close()
+        raise
+
+    logger.info(f"EXTRACTED {len(members)} PDF files from {archive_name}")
+    return members
+
+
+class _NoJob:
+    def update(self, **fields):
+        pass
@@ -1,9 +1,13 @@
 import time
 import sys
+import hashlib
+import queue
 import shutil
+import threading
 
 from logger import logger
 from exception import AppException
+from utils.util import batched, read_json, write_json, get_collection_meta_dir
 
 import os
 for key, value in os.environ.items():
@@ -14,6 +18,83 @@ from pymilvus import MilvusClient, FieldSchema, CollectionSchema, DataType, Coll
 from langchain_milvus.retrievers import MilvusCollectionHybridSearchRetriever
 
 
+# Default build and search parameters of the supported dense index types
+DENSE_INDEX_DEFAULTS = {
+    "FLAT": {"params": {}, "search_params": {}},
+    "IVF_FLAT": {"params": {"nlist": 128}, "search_params": {"nprobe": 16}},
+    "IVF_SQ8": {"params": {"nlist": 128}, "search_params": {"nprobe": 16}},
+    "IVF_PQ": {"params": {"nlist": 128, "m": 8, "nbits": 8}, "search_params": {"nprobe": 16}},
+    "HNSW": {"params": {"M": 16, "efConstruction": 200}, "search_params": {"ef": 64}},
+    "AUTOINDEX": {"params": {}, "search_params": {}},
+}
+
+
+def resolve_dense_index_config(index_type="FLAT", index_params=None, search_params=None):
+    '''
+    Merges user supplied index parameters over the defaults of an index type.
+
+    Args:
+        index_type: One of the keys of DENSE_INDEX_DEFAULTS.
+        index_params: Build parameters, e.g. {"M": 32} for HNSW.
+        search_params: Search parameters, e.g. {"ef": 128} for HNSW.
+
+    Returns:
+        A dict with "index_type", "params" and "search_params".
+    '''
+    index_type = index_type.upper()
+    if index_type not in DENSE_INDEX_DEFAULTS:
+        raise ValueError(f"Unsupported index type {index_type}, expected one of {list(DENSE_INDEX_DEFAULTS)}")
+
+    defaults = DENSE_INDEX_DEFAULTS[index_type]
+    return {"index_type": index_type,
+            "params": defaults["params"] | (index_params or {}),
+            "search_params": defaults["search_params"] | (search_params or {})
+            }
+
+
+def save_index_config(meta_dir, collection_name, index_config):
+    os.makedirs(meta_dir, exist_ok=True)
+    write_json(os.path.join(meta_dir, f"{collection_name}.index.json"), index_config)
+
+
+def load_index_config(meta_dir, collection_name):
+    '''
+    Returns the dense index config saved for a collection, or the FLAT defaults for 
+    collections created before index configs were saved.
+    '''
+    index_config = read_json(os.path.join(meta_dir, f"{collection_name}.index.json"))
+    return index_config or resolve_dense_index_config("FLAT")
+
+
+def load_source_manifest(meta_dir, collection_name):
+    '''
+    Returns the ingestion record of every source of a collection, 
+    {source: {"file_hash", "chunk_count", "complete"}}.
+    '''
+    return read_json(os.path.join(meta_dir, f"{collection_name}.sources.json")) or {}
+
+
+def save_source_manifest(meta_dir, collection_name, manifest):
+    os.makedirs(meta_dir, exist_ok=True)
+    write_json(os.path.join(meta_dir, f"{collection_name}.sources.json"), manifest)
+
+
+def drop_source_manifest(meta_dir, collection_name):
+    file_path = os.path.join(meta_dir, f"{collection_name}.sources.json")
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def _add_dense_index(index_params, index_config):
+    index_params.add_index(
+        field_name="dense_embed",
+        metric_type="COSINE",
+        index_type=index_config["index_type"],
+        index_name="dense_index",
+        params=index_config["params"],
+    )
+
+
 #Create vector store instance
 def create_milvus(db_uri="./milvus_demo.db", make_new_db=False):
     '''
@@ -40,7 +121,7 @@ def create_milvus(db_uri="./milvus_demo.db", make_new_db=False):
 
 
 # Create a collection and add documents to it
-def create_or_load_collection(collection_name, client, embed_dim):
+def create_or_load_collection(collection_name, client, embed_dim, index_config=None, meta_dir=None):
     '''
     Creates a new collection in Milvus if it doesn't exist, or loads an existing collection.
 
@@ -48,7 +129,11 @@ def create_or_load_collection(collection_name, client, embed_dim):
         collection_name: The name of the collection.
         client: The MilvusClient object.
         embed_dim: The dimensionality of the embedding vectors.
+        index_config: Dense index config from `resolve_dense_index_config`, used on creation only.
+            Defaults to FLAT.
+        meta_dir: Directory where the index config of a new collection is saved.
     '''
+    index_config = index_config or resolve_dense_index_config("FLAT")
     
     try:
         if client.has_collection(collection_name):
@@ -64,19 +149,17 @@ def create_or_load_collection(collection_name, client, embed_dim):
                     FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
                     FieldSchema(name="dense_embed", dtype=DataType.FLOAT_VECTOR, dim=embed_dim),
                     FieldSchema(name="sparse_embed", dtype=DataType.SPARSE_FLOAT_VECTOR),
-                    FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65_535)
+                    FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65_535),
+                    FieldSchema(name="source", dtype=DataType.VARCHAR, max_length=1_024),
+                    FieldSchema(name="file_hash", dtype=DataType.VARCHAR, max_length=64),
+                    FieldSchema(name="chunk_hash", dtype=DataType.VARCHAR, max_length=64)
                 ]
             )
 
             index_params = client.prepare_index_params()
 
             # Add an index on the vector field.
-            index_params.add_index(
-                field_name="dense_embed",
-                metric_type="COSINE",
-                index_type="FLAT",
-                index_name="dense_index",
-            )
+            _add_dense_index(index_params, index_config)
 
             index_params.add_index(
                 field_name="sparse_embed",
@@ -92,7 +175,10 @@ def create_or_load_collection(collection_name, client, embed_dim):
                 consistency_level="Strong",
             )
 
-            logger.info(f"CREATED Collection with name {collection_name}")
+            if meta_dir is not None:
+                save_index_config(meta_dir, collection_name, index_config)
+
+            logger.info(f"CREATED Collection with name {collection_name} and {index_config['index_type']} dense index")
 
     except Exception as e:
         raise AppException(e, sys)
@@ -102,65 +188,434 @@ def create_or_load_collection(collection_name, client, embed_dim):
             }
 
 
+# Embed documents in batches with the dense and sparse models
+def embed_documents_in_batches(texts, embed_model, sparse_embed_model, dense_batch_size=32, sparse_batch_size=256):
+    '''
+    Generates dense and sparse embeddings for a list of texts.
+
+    Each model is called once per batch instead of once per text, and the
+    two models can use different batch sizes.
+
+    Args:
+        texts: A list of strings to embed.
+        embed_model: The model used to generate dense embeddings.
+        sparse_embed_model: The model used to generate sparse embeddings.
+        dense_batch_size: The number of texts sent to the dense model per call.
+        sparse_batch_size: The number of texts sent to the sparse model per call.
+
+    Returns:
+        dense_embeddings, sparse_embeddings: Two lists aligned with `texts`.
+    '''
+    dense_embeddings = []
+    for i in range(0, len(texts), dense_batch_size):
+        dense_embeddings.extend(embed_model.embed_documents(texts[i:i + dense_batch_size]))
+
+    sparse_embeddings = []
+    for i in range(0, len(texts), sparse_batch_size):
+        sparse_embeddings.extend(sparse_embed_model.embed_documents(texts[i:i + sparse_batch_size]))
+
+    return dense_embeddings, sparse_embeddings
+
+
+# Scalar fields used to deduplicate chunks across uploads
+HASH_FIELDS = ("source", "file_hash", "chunk_hash")
+
+
+def _string_literal(value):
+    # Quoted string literal of a Milvus filter expression
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def content_hash(data):
+    '''
+    Returns the SHA-256 hex digest of a string or bytes.
+    '''
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_content_hash(file_path, salt=""):
+    '''
+    Returns the SHA-256 hex digest of a file (path or binary file object), read in 
+    blocks, prefixed with `salt`.
+    '''
+    if isinstance(file_path, (str, os.PathLike)):
+        with open(file_path, "rb") as f:
+            return file_content_hash(f, salt=salt)
+
+    hasher = hashlib.sha256(salt.encode("utf-8"))
+    for block in iter(lambda: file_path.read(1 << 20), b""):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+class ChunkDeduplicator:
+    '''
+    Compares the chunks of one uploaded file with the rows already stored for the 
+    same source, so a re-upload only embeds new chunks and deletes vanished ones.
+
+    Whether a source was ingested completely is read from its record in the source 
+    manifest, not from the stored rows: a run that failed partway leaves rows behind.
+
+    Collections created before the hash fields existed are passed through unchanged.
+    '''
+
+    def __init__(self, collection_name, client, source, file_hash, record=None):
+        '''
+        Args:
+            collection_name: The name of the collection.
+            client: The MilvusClient object.
+            source: The file name the chunks are stored under.
+            file_hash: Hash of the uploaded file, see `file_content_hash`.
+            record: The source's entry of the source manifest, None if it has none.
+        '''
+        self.collection_name = collection_name
+        self.client = client
+        self.source = source
+        self.file_hash = file_hash
+        self.record = record
+        self.skipped = 0
+        self.deleted = 0
+        self._seen = set()
+        self._inserted = []
+
+        fields = [field["name"] for field in client.describe_collection(collection_name)["fields"]]
+        self.enabled = all(field in fields for field in HASH_FIELDS)
+
+        self._existing = {}
+        if self.enabled:
+            for row in client.query(collection_name=collection_name,
+                                    filter=f"source == {_string_literal(source)}",
+                                    output_fields=["id", "chunk_hash", "file_hash"]
+                                    ):
+                self._existing.setdefault(row["chunk_hash"], []).append(row)
+        else:
+            logger.info(f"Collection {collection_name} has no hash fields, deduplication disabled")
+
+    def is_unchanged(self):
+        '''
+        True if the same file was already ingested completely under this source.
+        '''
+        return (self.record is not None 
+                and self.record["complete"] 
+                and self.record["file_hash"] == self.file_hash)
+
+    def conflicts(self):
+        '''
+        True if a file with different content is stored under this source, i.e. the 
+        upload is either a revision or another document with the same name.
+        '''
+        if self.record is not None:
+            return self.record["file_hash"] != self.file_hash
+        # Sources ingested before the manifest existed
+        file_hashes = {row["file_hash"] for rows in self._existing.values() for row in rows}
+        return bool(file_hashes) and self.file_hash not in file_hashes
+
+    def to_record(self, complete):
+        '''
+        Returns the source manifest entry of this upload.
+        '''
+        return {"file_hash": self.file_hash, "chunk_count": len(self._seen), "complete": complete}
+
+    def filter_new(self, documents):
+        '''
+        Tags documents with their hashes and yields only chunks not yet stored for 
+        this source (nor already seen in this upload).
+        '''
+        for doc in documents:
+            if not self.enabled:
+                yield doc
+                continue
+
+            chunk_hash = content_hash(doc.page_content)
+            if chunk_hash in self._seen or chunk_hash in self._existing:
+                self._seen.add(chunk_hash)
+                self.skipped += 1
+                continue
+
+            self._seen.add(chunk_hash)
+            self._inserted.append(chunk_hash)
+            doc.metadata |= {"source": self.source, "file_hash": self.file_hash, "chunk_hash": chunk_hash}
+            yield doc
+
+    def delete_inserted(self, batch_size=1000):
+        '''
+        Deletes the rows of the chunks this upload yielded as new, undoing a failed run.
+        They were not stored for this source before, so no earlier row is touched.
+
+        Returns:
+            False if the rows cannot be identified (no hash fields), True otherwise.
+        '''
+        if not self.enabled:
+            return False
+
+        for hashes in batched(self._inserted, batch_size):
+            chunk_hashes = ", ".join(_string_literal(chunk_hash) for chunk_hash in hashes)
+            self.client.delete(collection_name=self.collection_name,
+                               filter=f"source == {_string_literal(self.source)} and chunk_hash in [{chunk_hashes}]"
+                               )
+
+        logger.info(f"DELETED up to {len(self._inserted)} chunks of {self.source} inserted by a failed run")
+        return True
+
+    def delete_stale(self):
+        '''
+        Deletes the stored chunks of this source that were not in the upload.
+        Call once the upload has been fully consumed.
+
+        Returns:
+            The texts of the deleted chunks.
+        '''
+        if not self.enabled:
+            return []
+
+        stale_ids = [row["id"] for chunk_hash, rows in self._existing.items() 
+                     if chunk_hash not in self._seen for row in rows]
+        if not stale_ids:
+            return []
+
+        stale_texts = [row["text"] for row in self.client.query(collection_name=self.collection_name,
+                                                                ids=stale_ids,
+                                                                output_fields=["text"]
+                                                                )]
+        self.client.delete(collection_name=self.collection_name, ids=stale_ids)
+        self.deleted = len(stale_ids)
+
+        logger.info(f"DELETED {len(stale_ids)} stale chunks of {self.source} from {self.collection_name}")
+
+        return stale_texts
+
+
+def _orm_connection(db_uri, alias="default"):
+    '''
+    Returns the alias of the ORM connection to `db_uri`, used by `Collection`, connecting on first use.
+    '''
+    if not connections.has_connection(alias):
+        connections.connect(alias=alias, uri=db_uri)
+    return alias
+
+
+# Insert stage of the ingestion pipeline, runs in its own thread
+def _insert_worker(collection_name, client, batch_queue, batch_size, insert_batch_bytes, columnar, db_uri, stats, progress_callback):
+    '''
+    Consumes embedded column batches from `batch_queue` and inserts them into Milvus 
+    until a `None` sentinel is received.
+
+    Batches are merged until they hold about `insert_batch_bytes` of payload (or 
+    `batch_size` rows, if set), so one insert call usually covers several 
+    embedding batches. Progress is counted locally instead of asking Milvus.
+    '''
+    collection = Collection(collection_name, using=_orm_connection(db_uri)) if columnar else None
+    pending = {}
+    pending_bytes = 0
+
+    def flush():
+        num_rows = len(pending["text"])
+        step = batch_size or num_rows
+        insert_start_time = time.time()
+
+        for i in range(0, num_rows, step):
+            columns = pending if step == num_rows else {field: values[i:i + step] for field, values in pending.items()}
+
+            if columnar:
+                # Field order of `columns` follows the collection schema
+                collection.insert(data=list(columns.values()))
+            else:
+                client.insert(collection_name=collection_name, 
+                              data=[dict(zip(columns, values)) for values in zip(*columns.values())]
+                              )
+            stats["inserted"] += len(columns["text"])
+            stats["insert_calls"] += 1
+
+        stats["insert_time"] += time.time() - insert_start_time
+        logger.info(f"INSERTED {stats['inserted']} vectors in {stats['insert_calls']} calls")
+        if progress_callback is not None:
+            progress_callback(chunks_inserted=stats["inserted"])
+
+    while True:
+        item = batch_queue.get()
+        if stats["error"] is not None:
+            # Keep draining so the producer never blocks on a full queue
+            if item is None:
+                return
+            continue
+
+        try:
+            if item is None:
+                if pending:
+                    flush()
+                return
+
+            columns, num_bytes = item
+            for field, values in columns.items():
+                pending.setdefault(field, []).extend(values)
+            pending_bytes += num_bytes
+
+            if pending_bytes >= insert_batch_bytes or (batch_size and len(pending["text"]) >= batch_size):
+                flush()
+                pending, pending_bytes = {}, 0
+
+        except Exception as e:
+            stats["error"] = e
+            if item is None:
+                return
+
+
+# Rebuild the dense index of an existing collection
+def reindex_collection(collection_name, client, index_config, meta_dir):
+    '''
+    Replaces the dense index of an existing collection.
+
+    Args:
+        collection_name: The name of the collection.
+        client: The MilvusClient object.
+        index_config: Dense index config from `resolve_dense_index_config`.
+        meta_dir: Directory where the index config is saved.
+    '''
+    try:
+        client.release_collection(collection_name=collection_name)
+        client.drop_index(collection_name=collection_name, index_name="dense_index")
+
+        index_params = client.prepare_index_params()
+        _add_dense_index(index_params, index_config)
+        client.create_index(collection_name=collection_name, index_params=index_params)
+
+        client.load_collection(collection_name)
+        save_index_config(meta_dir, collection_name, index_config)
+
+        logger.info(f"REINDEXED Collection with name {collection_name} with {index_config['index_type']} dense index")
+
+    except Exception as e:
+        raise AppException(e, sys)
+
+    return {"message": "Collection reindexed successfully!",
+            "index_config": index_config,
+            "collection_status": client.get_load_state(collection_name = collection_name)
+            }
+
+
 # Add documents to the collection
-def add_documents_to_collection(collection_name, client, documents, embed_model, batch_size, sparse_embed_model):
+def add_documents_to_collection(collection_name, client, documents, embed_model, batch_size, sparse_embed_model,
+                                dense_batch_size=32, sparse_batch_size=256, max_pending_batches=2,
+                                insert_batch_bytes=8 * 2**20, columnar=False, db_uri=None, progress_callback=None):
     '''
     Adds documents to the specified Milvus collection.
 
-    This function iterates through a list of documents, generates embeddings for each document 
-    using the provided embedding models, and inserts the data into the Milvus collection.
+    Documents are pulled lazily from `documents`, embedded in batches using the provided 
+    embedding models, and handed to an insert thread through a bounded queue, so each 
+    embedded batch is inserted while the next one is still embedding. Peak memory 
+    depends on the batch sizes, not on the number of documents.
 
     Args:
         collection_name: The name of the Milvus collection to add documents to.
         client: The MilvusClient object.
-        documents: A list of Document objects to be added.
+        documents: A list or generator of Document objects to be added.
         embed_model: The model used to generate dense embeddings.
+        batch_size: The maximum number of rows per insert call, or None to size 
+            inserts by `insert_batch_bytes` only.
         sparse_embed_model: The model used to generate sparse embeddings.
+        dense_batch_size: The number of chunks per dense embedding call.
+        sparse_batch_size: The number of chunks per sparse embedding call.
+        max_pending_batches: The number of embedded batches allowed to wait for insertion.
+        insert_batch_bytes: The approximate payload size of one insert call.
+        columnar: Insert column arrays through the ORM instead of a list of row dicts.
+        db_uri: URI of the Milvus database, needed by the ORM connection of `columnar` inserts.
+        progress_callback: Called with `chunks_embedded=` or `chunks_inserted=` counts as batches complete.
 
     '''
+    if columnar and db_uri is None:
+        raise ValueError("Columnar inserts need the db_uri of the ORM connection")
+
+    stats = {"inserted": 0, "insert_calls": 0, "insert_time": 0.0, "error": None}
+    extract_time = 0.0
+    embed_time = 0.0
+    num_chunks = 0
+
+    batch_queue = queue.Queue(maxsize=max_pending_batches)
+    insert_thread = threading.Thread(target=_insert_worker,
+                                     args=(collection_name, client, batch_queue, batch_size, 
+                                           insert_batch_bytes, columnar, db_uri, stats, progress_callback),
+                                     daemon=True
+                                     )
     try:
         start = time.time()
-        data = []
-        for doc in documents:
-            data.append({
-                "dense_embed": list(embed_model.embed_documents([doc.page_content])[0]),
-                "sparse_embed": sparse_embed_model.embed_documents([doc.page_content])[0],
-                "text": doc.page_content
-            })
+        # Documents not tagged by a ChunkDeduplicator still need values for the hash fields
+        schema_fields = {field["name"] for field in client.describe_collection(collection_name)["fields"]}
+        hash_fields = [field for field in HASH_FIELDS if field in schema_fields]
+
+        insert_thread.start()
+
+        doc_batches = batched(documents, max(dense_batch_size, sparse_batch_size))
+        while True:
+            extract_start_time = time.time()
+            doc_batch = next(doc_batches, None)
+            extract_time += time.time() - extract_start_time
+
+            if doc_batch is None or stats["error"] is not None:
+                break
+
+            embed_start_time = time.time()
+            texts = [doc.page_content for doc in doc_batch]
+            dense_embeddings, sparse_embeddings = embed_documents_in_batches(texts=texts,
+                                                                             embed_model=embed_model,
+                                                                             sparse_embed_model=sparse_embed_model,
+                                                                             dense_batch_size=dense_batch_size,
+                                                                             sparse_batch_size=sparse_batch_size
+                                                                             )
+            columns = {
+                "dense_embed": dense_embeddings,
+                "sparse_embed": sparse_embeddings,
+                "text": texts
+            }
+            columns |= {field: [str(doc.metadata.get(field, "")) for doc in doc_batch] for field in hash_fields}
+
+            # Approximate payload: float32 dense values, (index, value) sparse pairs, text
+            num_bytes = (4 * sum(len(dense) for dense in dense_embeddings)
+                         + 8 * sum(len(sparse) for sparse in sparse_embeddings)
+                         + sum(len(text) for text in texts)
+                         )
+            embed_time += time.time() - embed_start_time
+            num_chunks += len(texts)
+
+            if progress_callback is not None:
+                progress_callback(chunks_embedded=num_chunks)
+
+            batch_queue.put((columns, num_bytes))
+
+        batch_queue.put(None)
+        insert_thread.join()
         end = time.time()
 
-        # upload embeddings to milvus in batches of 5
-        insert_start_time = time.time()
-        
-        batch_size = batch_size
-        num_batches = ( len(data) + batch_size - 1) // batch_size
-        
-        for i in range(num_batches):
-            start_idx = i * batch_size
-            end_idx = min((i + 1) * batch_size, len(data))
-            batch_embeddings = data[start_idx:end_idx]
-            
-            client.insert(collection_name=collection_name, data=batch_embeddings)
-            
-            logger.info(f"INSERTED {client.get_collection_stats(collection_name = collection_name)['row_count']} vectors")
-        
-        insert_end_time = time.time()
+        if stats["error"] is not None:
+            raise stats["error"]
 
-        logger.info(f"Added {len(documents)} documents to collection {collection_name}")
+        logger.info(f"Added {num_chunks} documents to collection {collection_name}")
 
     except Exception as e:
+        if insert_thread.is_alive():
+            stats["error"] = stats["error"] or e
+            batch_queue.put(None)
+            # Let an insert in flight land first, callers may delete the rows of this run next
+            insert_thread.join()
         raise AppException(e, sys)
     
     return {"state": client.get_load_state(collection_name = collection_name)['state'],
             "collection_stats": client.get_collection_stats(collection_name = collection_name),
+            "insert_calls": stats["insert_calls"],
             "time_taken": {
-                "to_create_vectors": end - start,
-                "to_insert_in_collection": insert_end_time - insert_start_time
+                "to_extract_chunks": extract_time,
+                "to_create_vectors": embed_time,
+                "to_insert_in_collection": stats["insert_time"],
+                "wall_clock": end - start,
+                "embedding_chunks_per_second": num_chunks / max(embed_time, 1e-9),
+                "insert_chunks_per_second": num_chunks / max(stats["insert_time"], 1e-9),
+                "total_chunks_per_second": num_chunks / max(end - start, 1e-9)
                 }
             }
 
 # Convert collection into retriever
-def convert_collection_to_retriever(collection_name, env_vars, embed_model, sparse_embed_model, k=3):
+def convert_collection_to_retriever(collection_name, env_vars, embed_model, sparse_embed_model, k=3, search_params=None):
     '''
     Converts a Milvus collection into a retriever.
 
@@ -170,20 +625,22 @@ def convert_collection_to_retriever(collection_name, env_vars, embed_model, spar
         embed_model: The model used to generate dense embeddings.
         sparse_embed_model: The model used to generate sparse embeddings.
         k: The number of documents to retrieve.
+        search_params: Dense search parameters. Defaults to the ones saved 
+            with the collection's index config.
 
     Returns:
         A retriever object.
     '''
+    if search_params is None:
+        search_params = load_index_config(get_collection_meta_dir(env_vars), collection_name)["search_params"]
    
     sparse_search_params = {"metric_type": "IP"}
-    dense_search_params = {"metric_type": "COSINE", "params": {}}
+    dense_search_params = {"metric_type": "COSINE", "params": search_params}
 
-    connections.connect(alias="default", uri=env_vars['MILVUS_LOCAL_URI'])
-    
     try:
 
         retriever = MilvusCollectionHybridSearchRetriever(
-            collection=Collection(collection_name),
+            collection=Collection(collection_name, using=_orm_connection(env_vars['MILVUS_LOCAL_URI'])),
             anns_fields=['dense_embed','sparse_embed'], # 
             field_embeddings=[embed_model, sparse_embed_model],
             field_search_params=[dense_search_params, sparse_search_params], # 
@@ -1,10 +1,16 @@
+import os
+import re
 import sys
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from logger import logger
 from exception import AppException
 
 from langchain.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
 
 
 # Create a PDF Loader using the file path
@@ -41,29 +47,228 @@ def langchain_pdf_loader(file_path, chunk_size=1000, overlap=200):
     return splits_data
 
 
-# Create a PDF Loader using the file path
-def pypdf_loader(file_path, chunk_size=1000, overlap=200):
+# Lazily load and chunk a PDF file page by page
+def lazy_langchain_pdf_loader(file_path, chunk_size=1000, overlap=200, source=None):
+    '''
+    Lazily loads a PDF file and yields its chunks page by page.
+
+    Produces the same chunks as `langchain_pdf_loader`, but only one page 
+    is held in memory at a time.
+
+    Args:
+        file_path: The path to the PDF file, or a binary file object.
+        chunk_size: The size of each chunk.
+        overlap: The overlap between chunks.
+        source: The source metadata of the chunks when reading a file object.
+    
+    Yields:
+        Document objects.
+    '''
     try:
-        pdf_file = open(file_path, 'rb')
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        if isinstance(file_path, (str, os.PathLike)):
+            pages = PyPDFLoader(file_path=file_path).lazy_load()
+        else:
+            pages = _iter_pages(file_path, source)
+
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, 
+                                                        chunk_overlap=overlap, 
+                                                        )
+        
+        for page in pages:
+            yield from text_splitter.split_documents([page])
 
-        text = []
-        for i in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[i]
-            text.append(page.extract_text())
+        logger.info("PDF loaded and splitted into chunks")
 
-        logger.info("PDF loaded")
+    except Exception as e:
+        raise AppException(e, sys)
+
+
+def _iter_pages(file, source):
+    '''
+    Yields one Document per page of a PDF read with pypdf, with the same metadata 
+    as PyPDFLoader.
+    '''
+    from pypdf import PdfReader
+
+    for page_number, page in enumerate(PdfReader(file).pages):
+        yield Document(page_content=page.extract_text(), metadata={"source": source, "page": page_number})
+
+
+# Extract and chunk a range of pages, runs in a worker process
+def _load_page_range(file_path, start_page, end_page, chunk_size, overlap, chunking="recursive", source=None):
+    '''
+    Extracts pages [start_page, end_page) of a PDF and splits them into chunks.
+
+    Returns:
+        A list of Document objects in page order.
+    '''
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, 
+                                                    chunk_overlap=overlap, 
+                                                    )
+    splits_data = []
+    for page_number in range(start_page, end_page):
+        text = reader.pages[page_number].extract_text()
+        metadata = {"source": source or file_path, "page": page_number}
+
+        if chunking == "recursive":
+            splits_data.extend(text_splitter.split_documents([Document(page_content=text, metadata=metadata)]))
+        else:
+            splits_data.extend(chunk_page(text, metadata, chunk_size, overlap, chunking))
+
+    return splits_data
+
+
+# Extract and chunk a PDF across a pool of processes
+def parallel_pdf_loader(file_path, chunk_size=1000, overlap=200, num_workers=None, pages_per_shard=None, chunking="recursive",
+                        source=None):
+    '''
+    Loads a PDF file with a process pool, each worker extracting and chunking a 
+    contiguous page range, and yields the chunks in page order.
+
+    Chunks never span pages (as with `langchain_pdf_loader`, which splits each page 
+    on its own), so page-aligned shards give the same chunks and overlaps as a 
+    single-process run.
+
+    Args:
+        file_path: The path to the PDF file.
+        chunk_size: The size of each chunk.
+        overlap: The overlap between chunks.
+        num_workers: The number of worker processes. Defaults to the number of CPUs.
+        pages_per_shard: The number of pages per task. Defaults to spreading the 
+            pages over four tasks per worker.
+        chunking: "recursive" for LangChain's splitter, or "char"/"token" for `chunk_page`.
+        source: The source metadata of the chunks, defaults to `file_path`.
+
+    Yields:
+        Document objects.
+    '''
+    from pypdf import PdfReader
+
+    try:
+        num_workers = num_workers or os.cpu_count() or 1
+        num_pages = len(PdfReader(file_path).pages)
+        pages_per_shard = pages_per_shard or max(1, -(-num_pages // (num_workers * 4)))
+        shards = [(start, min(start + pages_per_shard, num_pages)) for start in range(0, num_pages, pages_per_shard)]
+
+        logger.info(f"LOADING PDF with {num_pages} pages in {len(shards)} shards on {num_workers} processes")
+
+        # Spawned workers: forking the threaded server (batcher, ingest pool, gRPC, torch) 
+        # can deadlock and would copy the loaded models into every worker
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Keep a bounded window of shards in flight so finished shards 
+            # do not pile up in memory while the consumer is busy
+            pending = deque()
+            shard_iter = iter(shards)
+            for start_page, end_page in shard_iter:
+                pending.append(executor.submit(_load_page_range, file_path, start_page, end_page, chunk_size, overlap, chunking, source))
+                if len(pending) >= num_workers * 2:
+                    break
+
+            while pending:
+                splits_data = pending.popleft().result()
+                next_shard = next(shard_iter, None)
+                if next_shard is not None:
+                    pending.append(executor.submit(_load_page_range, file_path, *next_shard, chunk_size, overlap, chunking, source))
+                yield from splits_data
+
+        logger.info("PDF loaded and splitted into chunks")
 
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            if end > len(text):
-                end = len(text)  # Handle the last chunk
-            chunks.append(text[start:end])
-            start += chunk_size - overlap  # Adjust starting position with overlap
-    
     except Exception as e:
         raise AppException(e, sys)
+
+
+# Split a page into chunks on character or whitespace-token offsets
+def chunk_page(text, metadata, chunk_size=1000, overlap=200, chunking="char"):
+    '''
+    Splits the text of one page into overlapping chunks.
+
+    Chunk boundaries are computed as offsets into the page text, so each chunk 
+    costs exactly one slice.
+
+    Args:
+        text: The page text.
+        metadata: The metadata copied onto every chunk.
+        chunk_size: The size of each chunk, in characters or tokens.
+        overlap: The overlap between chunks, in characters or tokens.
+        chunking: "char" for character offsets, "token" for whitespace-separated tokens.
+
+    Returns:
+        A list of Document objects.
+    '''
+    step = chunk_size - overlap
+    if step <= 0:
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_size ({chunk_size})")
+
+    if chunking == "token":
+        spans = [match.span() for match in _TOKEN_PATTERN.finditer(text)]
+        boundaries = [(spans[start][0], spans[min(start + chunk_size, len(spans)) - 1][1])
+                      for start in _window_starts(len(spans), chunk_size, step)]
+    elif chunking == "char":
+        boundaries = [(start, min(start + chunk_size, len(text)))
+                      for start in _window_starts(len(text), chunk_size, step)]
+    else:
+        raise ValueError(f"Unknown chunking {chunking}, expected 'char' or 'token'")
+
+    chunks = []
+    for start, end in boundaries:
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(Document(page_content=chunk, metadata=dict(metadata)))
+    return chunks
+
+
+_TOKEN_PATTERN = re.compile(r"\S+")
+
+
+def _window_starts(length, size, step):
+    '''
+    Start offsets of windows of `size` every `step` items, stopping at the window 
+    that reaches the end.
+    '''
+    start = 0
+    while start < length:
+        yield start
+        if start + size >= length:
+            return
+        start += step
+
+
+# Create a fast PDF Loader using the file path
+def pypdf_loader(file_path, chunk_size=1000, overlap=200, chunking="char", source=None):
+    '''
+    Loads a PDF file with pypdf and chunks each page on character or token offsets.
+
+    A faster alternative to `langchain_pdf_loader` when LangChain's recursive 
+    separators are not needed. Pages are streamed one at a time and the chunks 
+    have the same Document shape (page_content, source and page metadata).
+
+    Args:
+        file_path: The path to the PDF file, or a binary file object.
+        chunk_size: The size of each chunk, in characters or tokens.
+        overlap: The overlap between chunks, in characters or tokens.
+        chunking: "char" or "token".
+        source: The source metadata of the chunks, defaults to `file_path`.
+    
+    Yields:
+        Document objects.
+    '''
+    from pypdf import PdfReader
+
+    try:
+        pdf_reader = PdfReader(file_path)
+
+        for page_number, page in enumerate(pdf_reader.pages):
+            yield from chunk_page(text=page.extract_text(),
+                                  metadata={"source": source or file_path, "page": page_number},
+                                  chunk_size=chunk_size,
+                                  overlap=overlap,
+                                  chunking=chunking
+                                  )
+
+        logger.info("PDF loaded and splitted into chunks")
     
-    return chunks
\ No newline at end of file
+    except Exception as e:
+        raise AppException(e, sys)
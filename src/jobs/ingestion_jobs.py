@@ -0,0 +1,262 @@
+import os
+import sys
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import logger
+from exception import AppException
+from utils.util import read_json, write_json
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks (Windows), collection locks only hold within the process
+    fcntl = None
+
+
+class IngestionJob:
+    '''
+    Progress of one background ingestion, updated by the worker and read by /jobs/{id}.
+    '''
+
+    def __init__(self, job_id, description, on_update=None):
+        self.job_id = job_id
+        self.description = description
+        self.status = "queued"
+        self.stage = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.chunks_embedded = 0
+        self.chunks_inserted = 0
+        self.pages_done = 0
+        self.pages_total = None
+        self.result = None
+        self.error = None
+        self._on_update = on_update
+        self._lock = threading.Lock()
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+        if self._on_update is not None:
+            self._on_update(self, fields)
+
+    def to_dict(self):
+        with self._lock:
+            now = self.finished_at or time.time()
+            elapsed = now - self.started_at if self.started_at else 0.0
+            throughput = self.chunks_embedded / elapsed if elapsed else 0.0
+
+            # Pages are known up front while chunk counts are not, so the ETA 
+            # extrapolates from the share of pages already processed
+            eta = None
+            if self.status == "running" and self.pages_total and self.pages_done:
+                done = self.pages_done / self.pages_total
+                eta = elapsed * (1 - done) / done
+
+            return {"job_id": self.job_id,
+                    "status": self.status,
+                    "stage": self.stage,
+                    **self.description,
+                    "pages_done": self.pages_done,
+                    "pages_total": self.pages_total,
+                    "chunks_embedded": self.chunks_embedded,
+                    "chunks_inserted": self.chunks_inserted,
+                    "elapsed_seconds": elapsed,
+                    "throughput_chunks_per_second": throughput,
+                    "eta_seconds": eta,
+                    "result": self.result,
+                    "error": self.error
+                    }
+
+
+class StoredJob:
+    '''
+    Progress of a job run by another API worker, as last written to the job store.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class CollectionLock:
+    '''
+    Lock of a collection held across the API worker processes: a thread lock for
+    the runs of this process plus an exclusive `flock` on a file shared with the
+    other workers.
+    '''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self.file_path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Closing the file releases the flock
+        self._file.close()
+        self._file = None
+        self._thread_lock.release()
+        return False
+
+
+class IngestionJobManager:
+    '''
+    Runs ingestion jobs on a bounded worker pool and keeps their progress for polling.
+
+    `max_concurrent_jobs` caps how many ingestions run at once so they cannot 
+    starve query traffic; further jobs wait in the queue. Runs on the same 
+    collection take its `collection_lock` and go one at a time.
+
+    With `state_dir`, several API workers can share the manager's state: collection 
+    locks also lock a file there, and job progress is written there (at most every 
+    `persist_interval` seconds while running), so any worker can report any job.
+    '''
+
+    def __init__(self, max_concurrent_jobs=2, max_finished_jobs=1000, state_dir=None, persist_interval=1.0):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.state_dir = state_dir
+        self.persist_interval = persist_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix="ingest")
+        self._jobs = OrderedDict()
+        self._collection_locks = {}
+        self._persisted_at = {}
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()
+
+        if state_dir:
+            os.makedirs(self._job_dir(), exist_ok=True)
+
+    def _job_dir(self):
+        return os.path.join(self.state_dir, "jobs")
+
+    def _job_path(self, job_id):
+        return os.path.join(self._job_dir(), f"{job_id}.json")
+
+    def submit(self, func, description, cleanup=None):
+        '''
+        Queues `func(job)` and returns the job immediately.
+
+        Args:
+            func: Callable taking the IngestionJob and returning a JSON-serializable result.
+            description: Dict of fields shown with the job, e.g. file name and collection.
+            cleanup: Optional callable run after the job, whether it succeeded or not.
+
+        Returns:
+            The IngestionJob.
+        '''
+        job = IngestionJob(job_id=uuid.uuid4().hex,
+                           description=description,
+                           on_update=self._persist if self.state_dir else None
+                           )
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict_finished()
+        if self.state_dir:
+            self._persist(job, {"status": job.status})
+
+        self._executor.submit(self._run, job, func, cleanup)
+        logger.info(f"QUEUED ingestion job {job.job_id} {description}")
+        return job
+
+    def collection_lock(self, collection_name):
+        '''
+        Returns the lock held by the ingestion runs of a collection.
+        '''
+        with self._lock:
+            if collection_name not in self._collection_locks:
+                if self.state_dir and fcntl is not None:
+                    lock = CollectionLock(os.path.join(self.state_dir, f"{collection_name}.lock"))
+                else:
+                    lock = threading.Lock()
+                self._collection_locks[collection_name] = lock
+            return self._collection_locks[collection_name]
+
+    def _persist(self, job, fields):
+        # Progress updates are throttled, status changes are always written
+        now = time.time()
+        if "status" not in fields and now - self._persisted_at.get(job.job_id, 0) < self.persist_interval:
+            return
+        try:
+            with self._store_lock:
+                write_json(self._job_path(job.job_id), job.to_dict())
+                self._persisted_at[job.job_id] = now
+        except Exception as e:
+            logger.error(f"FAILED to store the progress of ingestion job {job.job_id}: {e}")
+
+    def _run(self, job, func, cleanup):
+        job.update(status="running", stage="starting", started_at=time.time())
+        try:
+            result = func(job)
+            job.update(status="succeeded", stage="done", result=result, finished_at=time.time())
+            logger.info(f"FINISHED ingestion job {job.job_id}")
+
+        except Exception as e:
+            error = e if isinstance(e, AppException) else AppException(e, sys)
+            job.update(status="failed", stage="failed", error=str(error), finished_at=time.time())
+            logger.error(f"FAILED ingestion job {job.job_id}: {error}")
+
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    def _evict_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+            if self.state_dir:
+                self._persisted_at.pop(job_id, None)
+                if os.path.exists(self._job_path(job_id)):
+                    os.remove(self._job_path(job_id))
+
+    def _load_stored(self, job_id):
+        try:
+            data = read_json(self._job_path(job_id))
+        except (OSError, ValueError):
+            return None
+        return StoredJob(data) if data is not None else None
+
+    def get(self, job_id):
+        '''
+        Returns a job of this worker, or with `state_dir` the stored progress of 
+        another worker's job, or None.
+        '''
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.state_dir and os.path.basename(job_id) == job_id:
+            job = self._load_stored(job_id)
+        return job
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if self.state_dir:
+            local_ids = {job.job_id for job in jobs}
+            for file_name in sorted(os.listdir(self._job_dir())):
+                job_id, extension = os.path.splitext(file_name)
+                if extension == ".json" and job_id not in local_ids:
+                    job = self._load_stored(job_id)
+                    if job is not None:
+                        jobs.append(job)
+        return jobs
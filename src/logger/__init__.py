@@ -1,7 +1,6 @@
 import logging
 from datetime import datetime
 import os
-import shutil
 
 LOG_DIR = "logs"
 TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -12,8 +11,7 @@ def get_log_file_name():
 
 LOG_FILE_NAME = get_log_file_name()
 
-if os.path.exists(LOG_DIR):
-    shutil.rmtree(LOG_DIR)
+# Each run logs to its own timestamped file, earlier logs are kept
 os.makedirs(LOG_DIR, exist_ok=True)
 
 LOG_FILE_PATH = os.path.join(LOG_DIR, LOG_FILE_NAME)
@@ -0,0 +1,64 @@
+import os
+import threading
+
+from logger import logger
+from utils.util import read_json, write_json
+
+
+class CollectionVersions:
+    '''
+    Per-collection change counters shared by the API workers through files in `store_dir`.
+
+    The worker changing a collection (ingestion, rollback, reindex, delete) calls `bump`
+    while holding the collection lock. Every worker calls `sync` before using what it
+    holds in memory for a collection; when another worker bumped the version since,
+    `on_change(collection_name)` drops the caches and models built from the earlier state.
+    '''
+
+    def __init__(self, store_dir, on_change):
+        self.store_dir = store_dir
+        self.on_change = on_change
+        self._seen = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, collection_name):
+        return os.path.join(self.store_dir, f"{collection_name}.version.json")
+
+    def _read(self, collection_name):
+        try:
+            state = read_json(self._path(collection_name))
+        except (OSError, ValueError):
+            # Unreadable, e.g. while another worker replaces it: treat as changed
+            return None
+        return state["version"] if state else 0
+
+    def bump(self, collection_name):
+        '''
+        Records a change of a collection and drops what this worker holds for it.
+        Must be called under the collection lock.
+        '''
+        version = (self._read(collection_name) or 0) + 1
+        write_json(self._path(collection_name), {"version": version})
+        with self._lock:
+            self._seen[collection_name] = version
+        self.on_change(collection_name)
+
+    def sync(self, collection_name):
+        '''
+        Drops what this worker holds for a collection if another worker changed it
+        since the last call.
+        '''
+        version = self._read(collection_name)
+        with self._lock:
+            if collection_name not in self._seen:
+                # Nothing was built for the collection before its first sync
+                self._seen[collection_name] = version
+                return
+            changed = version is None or version != self._seen[collection_name]
+            self._seen[collection_name] = version
+
+        if changed:
+            logger.info(f"COLLECTION {collection_name} changed in another worker, reloading")
+            self.on_change(collection_name)
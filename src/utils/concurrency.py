@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+
+class QueryLimiter:
+    '''
+    Async context manager bounding the number of questions answered at once.
+
+    Requests beyond `max_concurrency` wait for a slot; the number waiting is the
+    queue depth reported by `stats`.
+    '''
+
+    def __init__(self, max_concurrency=8):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.total_wait_time = 0.0
+
+    async def __aenter__(self):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        wait_start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.total_wait_time += time.perf_counter() - wait_start
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self.completed += 1
+        self._semaphore.release()
+        return False
+
+    def stats(self):
+        return {"max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "max_queue_depth": self.max_waiting,
+                "completed": self.completed,
+                "avg_wait_seconds": self.total_wait_time / self.completed if self.completed else 0.0
+                }
@@ -0,0 +1,76 @@
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    '''
+    LangChain callback handler recording the retrieval, prompt and LLM stages of
+    a chain run into a RequestTrace.
+
+    Dense and sparse search, and their RRF fusion, happen in one Milvus hybrid
+    search call and are reported together as `hybrid_search`.
+    '''
+
+    # Chain runs making up the prompt: formatting the documents, then the template
+    PROMPT_RUNS = ("format_inputs", "ChatPromptTemplate")
+
+    # Handlers only update dicts, run them in the calling thread instead of sending every 
+    # event (and streamed token) through the executor shared with the searches
+    run_inline = True
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._starts = {}
+        self._first_token_seen = set()
+
+    def _start(self, run_id, stage):
+        self._starts[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id):
+        if run_id in self._starts:
+            stage, start = self._starts.pop(run_id)
+            self.trace.add(stage, time.perf_counter() - start)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        name = kwargs.get("name") or ""
+        if name.startswith("Milvus"):
+            self._start(run_id, "hybrid_search")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs):
+        if kwargs.get("name") in self.PROMPT_RUNS:
+            self._start(run_id, "prompt_build")
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id in self._starts and run_id not in self._first_token_seen:
+            self._first_token_seen.add(run_id)
+            self.trace.add("llm_first_token", time.perf_counter() - self._starts[run_id][1])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        # Without streaming the whole answer is the first token
+        if run_id in self._starts and run_id not in self._first_token_seen:
+            self.trace.add("llm_first_token", time.perf_counter() - self._starts[run_id][1])
+        self._first_token_seen.discard(run_id)
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._first_token_seen.discard(run_id)
+        self._end(run_id)
@@ -0,0 +1,223 @@
+import os
+import sys
+import time
+import threading
+import traceback
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+from logger import logger
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    '''
+    Cumulative latency histogram in the Prometheus layout.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    '''
+    In-process per-stage latency histograms and request counters, rendered in the
+    Prometheus text exposition format.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self._histograms:
+                self._histograms[stage] = Histogram(self.buckets)
+            self._histograms[stage].observe(seconds)
+
+    def increment(self, name, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += 1
+
+    def render_prometheus(self):
+        lines = ["# HELP rag_stage_duration_seconds Time spent per stage of a question.",
+                 "# TYPE rag_stage_duration_seconds histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            declared = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in declared:
+                    lines.append(f"# TYPE {name} counter")
+                    declared.add(name)
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class RequestTrace:
+    '''
+    Spans of one request. Durations of a stage seen several times are summed, and
+    every stage is observed once in the metrics registry when the trace finishes.
+
+    The request is counted as an error when an exception leaves the trace, or when
+    `failed` is set for an error handled inside it.
+    '''
+
+    def __init__(self, metrics, endpoint, profiler=None):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.profiler = profiler
+        self.start = time.perf_counter()
+        self.spans = Counter()
+        self.failed = False
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.spans[stage] += seconds
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        if self.profiler is not None:
+            self.profiler.register(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _current_trace.reset(self._token)
+        except ValueError:
+            # The generator of a disconnected SSE stream is finalized in another context
+            pass
+        total = time.perf_counter() - self.start
+        self.add("total", total)
+
+        for stage, seconds in self.spans.items():
+            self.metrics.observe(stage, seconds)
+        status = "error" if exc_type or self.failed else "ok"
+        self.metrics.increment("rag_requests_total", endpoint=self.endpoint, status=status)
+
+        if self.profiler is not None:
+            self.profiler.unregister(self, total)
+        return False
+
+
+@contextmanager
+def span(stage):
+    '''
+    Times a block as `stage` of the current request's trace, if there is one.
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(stage):
+        yield
+
+
+class SlowRequestProfiler:
+    '''
+    Sampling profiler for slow requests.
+
+    While requests are in flight, a background thread samples the stacks of all
+    threads every `interval_ms`. When a request takes longer than `threshold_ms`,
+    its samples are logged as the most frequent stacks and, with `output_dir`,
+    written in the folded format read by flamegraph tools.
+
+    Concurrent requests share the samples taken while they overlap, so the
+    profile of a slow request can include the work of its neighbours.
+    '''
+
+    def __init__(self, metrics, threshold_ms=2000, interval_ms=10, output_dir=None, top_stacks=10):
+        self.metrics = metrics
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.top_stacks = top_stacks
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+
+    def register(self, trace):
+        with self._lock:
+            self._active[id(trace)] = Counter()
+        self._wakeup.set()
+
+    def unregister(self, trace, total):
+        with self._lock:
+            samples = self._active.pop(id(trace), Counter())
+        if total < self.threshold or not samples:
+            return
+
+        self.metrics.increment("rag_slow_requests_total", endpoint=trace.endpoint)
+        spans = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in trace.spans.items())
+        top = "\n".join(f"  {count:>5} {stack}" for stack, count in samples.most_common(self.top_stacks))
+        logger.warning(f"SLOW request on {trace.endpoint} ({total:.2f}s; {spans}), top sampled stacks:\n{top}")
+
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            file_path = os.path.join(self.output_dir, f"slow_{int(time.time() * 1000)}_{id(trace)}.folded")
+            with open(file_path, "w", encoding="utf-8") as f:
+                for stack, count in samples.items():
+                    f.write(f"{stack} {count}\n")
+
+    def _sample(self):
+        own_thread = threading.get_ident()
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            frames = traceback.extract_stack(frame)
+            stacks.append(";".join(f"{os.path.basename(entry.filename)}:{entry.name}" for entry in frames))
+        return stacks
+
+    def _run(self):
+        while True:
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                # Sleep until a request registers
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            for stack in self._sample():
+                for samples in active:
+                    samples[stack] += 1
+            time.sleep(self.interval)
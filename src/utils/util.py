@@ -1,8 +1,13 @@
+import io
 import os
 import sys
+import json
+import mmap
 import shutil
+import tempfile
 
 from datetime import datetime
+from itertools import islice
 
 from dateutil.parser import parse
 from dotenv import dotenv_values
@@ -56,24 +61,130 @@ class CommonUtils:
             return os.environ.get(variable_name)
     
 
-    
-def save_uploaded_file(file):
-    # Ensure the temporary directory exists
-    temp_dir = "temp"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-
-    # Define the path to save the uploaded file
-    file_path = os.path.join(temp_dir, file.filename)
-
-    # Save the uploaded file
-    try:
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        print(f"File saved successfully at {file_path}")
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-
-# Then, call `save_uploaded_file(file)` where `file` is the uploaded file object
+
+def batched(iterable, batch_size):
+    '''
+    Yields lists of up to `batch_size` items from any iterable.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_collection_meta_dir(env_vars):
+    '''
+    Returns the directory holding per-collection metadata (BM25 statistics etc.).
+    Defaults to a `collection_meta` folder next to the Milvus Lite database.
+    '''
+    if env_vars.get('COLLECTION_META_DIR'):
+        return env_vars['COLLECTION_META_DIR']
+    return os.path.join(os.path.dirname(env_vars['MILVUS_LOCAL_URI']), "collection_meta")
+
+
+def read_json(file_path):
+    '''
+    Reads a JSON file, returning None if it does not exist.
+    '''
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json(file_path, data):
+    '''
+    Writes `data` as JSON, replacing the file atomically.
+    '''
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, file_path)
+
+
+
+class SpooledUpload:
+    '''
+    Keeps the content of an uploaded file readable once the request is closed, 
+    without copying it to a named file.
+
+    Small uploads are kept as bytes. Uploads that Starlette already spooled to disk 
+    keep their anonymous temporary file alive through a duplicated descriptor and 
+    are read through a memory map. A uniquely named file is only written when a 
+    caller needs a path (e.g. worker processes).
+    '''
+
+    def __init__(self, filename, data=None, fd=None, temp_dir="temp"):
+        self.filename = filename
+        self.temp_dir = temp_dir
+        self._data = data
+        self._fd = fd
+        self._file_path = None
+
+    @classmethod
+    def from_upload(cls, file, temp_dir="temp"):
+        '''
+        Wraps a FastAPI UploadFile.
+        '''
+        spooled = file.file
+        # A SpooledTemporaryFile only has a descriptor once rolled over to disk, 
+        # asking for it earlier would force the rollover
+        if getattr(spooled, "_rolled", True):
+            try:
+                spooled.flush()
+                return cls(file.filename, fd=os.dup(spooled.fileno()), temp_dir=temp_dir)
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+
+        spooled.seek(0)
+        return cls(file.filename, data=spooled.read(), temp_dir=temp_dir)
+
+    @classmethod
+    def from_stream(cls, stream, filename, temp_dir="temp", max_memory_bytes=32 * 2**20):
+        '''
+        Reads a binary stream, e.g. an archive member, keeping up to `max_memory_bytes` 
+        in memory and spilling larger content to an unnamed temporary file.
+        '''
+        data = stream.read(max_memory_bytes + 1)
+        if len(data) <= max_memory_bytes:
+            return cls(filename, data=data, temp_dir=temp_dir)
+
+        os.makedirs(temp_dir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=temp_dir) as spill:
+            spill.write(data)
+            shutil.copyfileobj(stream, spill)
+            spill.flush()
+            return cls(filename, fd=os.dup(spill.fileno()), temp_dir=temp_dir)
+
+    def open(self):
+        '''
+        Returns a binary file object over the content, with its own read position.
+        '''
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        if os.fstat(self._fd).st_size == 0:
+            return io.BytesIO(b"")
+        return mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+
+    def file_path(self):
+        '''
+        Returns a path to the content, written once to a uniquely named temporary file.
+        '''
+        if self._file_path is None:
+            os.makedirs(self.temp_dir, exist_ok=True)
+            fd, file_path = tempfile.mkstemp(suffix=os.path.splitext(self.filename)[1], dir=self.temp_dir)
+            with os.fdopen(fd, "wb") as f, self.open() as content:
+                shutil.copyfileobj(content, f)
+            self._file_path = file_path
+        return self._file_path
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._file_path is not None and os.path.exists(self._file_path):
+            os.remove(self._file_path)
+        self._file_path = None
+        self._data = None